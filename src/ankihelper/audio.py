@@ -1,17 +1,25 @@
 import os
 import shutil
 from icecream import ic
-from pydub import AudioSegment
-from pydub.silence import detect_nonsilent
-import torch
-import whisper
-import json
 from tqdm import tqdm
 
 import click
 
-from .utils import (
-        save_whisper_result_as_vtt,
+from .transcriber import (
+        WhisperTranscriber,
+        load_whisper_model,
+        get_vtt_filepath,
+        transcribe_stream,
+        )
+from .cache import (
+        FileCache,
+        )
+from .silence import (
+        detect_nonsilent_stream,
+        )
+from .pcm import (
+        get_pcm_cache,
+        cut_segments,
         )
 
 @click.group()
@@ -26,42 +34,79 @@ def audio():
 @click.option("--silence_thresh", type=int, default=-60)
 def clip_per_silence(audio_filepaths, output_dir, min_silence_len, silence_thresh):
     os.makedirs(output_dir, exist_ok=True)
+
+    pcm_cache = get_pcm_cache()
     for audio_filepath in tqdm(audio_filepaths):
         input_filename = audio_filepath.split("/")[-1].split(".")[0]
-        audio = AudioSegment.from_file(audio_filepath)
         # 無音でない区間を取得（開始時間, 終了時間 のリスト）
-        nonsilent_chunks = detect_nonsilent(
-                audio,
+        # デコード済みのPCMをブロック毎に判定するので，長い音声でもメモリを使い切らない
+        nonsilent_chunks = list(detect_nonsilent_stream(
+                audio_filepath,
                 min_silence_len=min_silence_len,
-                silence_thresh=silence_thresh)
+                silence_thresh=silence_thresh,
+                cache=pcm_cache))
 
-        for i, (start, end) in enumerate(nonsilent_chunks):
-            chunk = audio[start:end]
-            chunk.export(f"{output_dir}/{input_filename}_{i:04d}.mp3", format="mp3")
-            print(f"Saved: {input_filename}_{i:04d}.mp3 ({start}ms - {end}ms)")
+        output_filenames = [
+                f"{input_filename}_{i:04d}.mp3"
+                for i in range(len(nonsilent_chunks))]
+        cut_segments(
+                audio_filepath,
+                [(start / 1000., end / 1000.) for start, end in nonsilent_chunks],
+                [os.path.join(output_dir, f) for f in output_filenames],
+                cache=pcm_cache)
+        for output_filename, (start, end) in zip(output_filenames, nonsilent_chunks):
+            print(f"Saved: {output_filename} ({start}ms - {end}ms)")
 
 
 @audio.command()
 @click.argument("audio_filepaths", type=str, nargs=-1)
 @click.option("--output_dir", type=str, default="/tmp/script")
+@click.option("--model", type=str, default="small")
+@click.option("--num-workers", type=int, default=1)
+@click.option("--no-cache", is_flag=True, default=False)
+@click.option("--stream", is_flag=True, default=False)
+@click.option("--window-sec", type=float, default=600.)
+@click.option("--overlap-sec", type=float, default=10.)
 @click.pass_context
-def to_script(ctx, audio_filepaths, output_dir):
-    device = "mps" if torch.backends.mps.is_available() else "cpu"
-    try:
-        model = whisper.load_model("small").to(device)
-        ic("Use MPS")
-    except NotImplementedError as e:
-        ic(e)
-        model = whisper.load_model("small", device="cpu")
-        ic("Use CPU")
-    for filepath in tqdm(audio_filepaths):
-        result = model.transcribe(
-                filepath,
-                word_timestamps=True,
-                fp16=False)
-        with open("/tmp/script.json", "w") as f:
-            json.dump(result, f, indent=2)
-
+def to_script(
+        ctx,
+        audio_filepaths,
+        output_dir,
+        model,
+        num_workers,
+        no_cache,
+        stream,
+        window_sec,
+        overlap_sec):
+    if stream and not 0 <= overlap_sec < window_sec:
+        raise click.BadParameter(
+                f"must be in [0, window-sec ({window_sec}))",
+                param_hint="--overlap-sec")
+    if stream:
+        # 長時間の音声向け: 窓毎に書き起こして逐次書き出す
         os.makedirs(output_dir, exist_ok=True)
-        output_filename = f'{os.path.basename(filepath)}.vtt'
-        save_whisper_result_as_vtt(result, os.path.join(output_dir, output_filename))
+        whisper_model = load_whisper_model(model)
+        for filepath in audio_filepaths:
+            vtt_filepath = get_vtt_filepath(filepath, output_dir)
+            jsonl_filepath = os.path.join(
+                    output_dir, f"{os.path.basename(filepath)}.jsonl")
+            num_cues = transcribe_stream(
+                    whisper_model,
+                    filepath,
+                    vtt_filepath,
+                    jsonl_filepath,
+                    window_sec=window_sec,
+                    overlap_sec=overlap_sec)
+            ic(vtt_filepath, jsonl_filepath, num_cues)
+        return
+
+    transcriber = WhisperTranscriber(
+            model_name=model,
+            num_workers=num_workers,
+            word_timestamps=True,
+            fp16=False,
+            cache=None if no_cache else FileCache("whisper"))
+    json_filepaths = transcriber.transcribe(list(audio_filepaths), output_dir)
+
+    if len(json_filepaths) > 0:
+        shutil.copyfile(json_filepaths[-1], "/tmp/script.json")
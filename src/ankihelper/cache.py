@@ -0,0 +1,195 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+
+import click
+from icecream import ic
+
+
+CACHE_ROOT = os.environ.get(
+        "ANKIHELPER_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "ankihelper"))
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+# 既定の容量と違うキャッシュ
+MAX_BYTES_BY_NAME = {
+        "pcm": 8 * 1024 ** 3,
+        "image": 4 * 1024 ** 3,
+        }
+
+
+def get_default_max_bytes(name):
+    return MAX_BYTES_BY_NAME.get(name, DEFAULT_MAX_BYTES)
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(filepath, chunk_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def normalize_text(text):
+    """キーに使うテキストの空白の違いを無くす"""
+    return " ".join(str(text).split())
+
+
+def make_key(*parts):
+    """任意の値の組からキャッシュキーを作る"""
+    return hash_bytes(json.dumps(parts, ensure_ascii=False).encode("utf-8"))
+
+
+def link_or_copy(src_filepath, dst_filepath):
+    """キャッシュのファイルを出力先へハードリンクし，できなければコピーする"""
+    if os.path.lexists(dst_filepath):
+        os.remove(dst_filepath)
+    try:
+        os.link(src_filepath, dst_filepath)
+    except OSError:
+        shutil.copyfile(src_filepath, dst_filepath)
+
+
+class FileCache():
+    """
+    キーのハッシュをファイル名とするディスクキャッシュ
+    参照時にmtimeを更新し，容量を超えたら古いものから消す(LRU)
+    """
+    def __init__(self, name, max_bytes=None, root=CACHE_ROOT):
+        self.name = name
+        self.max_bytes = get_default_max_bytes(name) if max_bytes is None else max_bytes
+        self.dirpath = os.path.join(root, name)
+        os.makedirs(self.dirpath, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        # 複数のスレッドから参照されても数え漏れがないようにする
+        self._lock = threading.Lock()
+
+    def path(self, key, ext=""):
+        return os.path.join(self.dirpath, key[:2], f"{key}{ext}")
+
+    def get(self, key, ext=""):
+        """ヒットしたらファイルのパスを，しなければNoneを返す"""
+        filepath = self.path(key, ext)
+        try:
+            os.utime(filepath)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return filepath
+
+    def put_file(self, key, src_filepath, ext=""):
+        filepath = self.path(key, ext)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        fd, tmp_filepath = tempfile.mkstemp(dir=os.path.dirname(filepath))
+        os.close(fd)
+        shutil.copyfile(src_filepath, tmp_filepath)
+        os.replace(tmp_filepath, filepath)
+        return filepath
+
+    def put_bytes(self, key, data, ext=""):
+        filepath = self.path(key, ext)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        fd, tmp_filepath = tempfile.mkstemp(dir=os.path.dirname(filepath))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_filepath, filepath)
+        return filepath
+
+    def get_json(self, key):
+        filepath = self.get(key, ".json")
+        if filepath is None:
+            return None
+        with open(filepath, "r") as f:
+            return json.load(f)
+
+    def put_json(self, key, obj):
+        return self.put_bytes(
+                key, json.dumps(obj, ensure_ascii=False).encode("utf-8"), ".json")
+
+    def _entries(self):
+        entries = list()
+        for dirpath, _, filenames in os.walk(self.dirpath):
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(filepath)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, filepath))
+        return entries
+
+    def stats(self):
+        entries = self._entries()
+        return {
+                "name": self.name,
+                "entries": len(entries),
+                "bytes": sum([size for _, size, _ in entries]),
+                "max_bytes": self.max_bytes,
+                }
+
+    def prune(self, max_bytes=None):
+        """合計サイズがmax_bytes以下になるまで最も古く参照されたものから消す"""
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = sorted(self._entries())
+        total = sum([size for _, size, _ in entries])
+        removed = 0
+        for _, size, filepath in entries:
+            if total <= max_bytes:
+                break
+            os.remove(filepath)
+            total -= size
+            removed += 1
+        return removed
+
+    def report(self):
+        print(f"cache[{self.name}] hit: {self.hits} miss: {self.misses}")
+
+
+def get_cache_names(root=CACHE_ROOT):
+    if not os.path.isdir(root):
+        return []
+    return sorted([
+        d for d in os.listdir(root)
+        if os.path.isdir(os.path.join(root, d))])
+
+
+@click.group()
+def cache():
+    pass
+
+
+@cache.command()
+def stats():
+    ic(CACHE_ROOT)
+    for name in get_cache_names():
+        s = FileCache(name).stats()
+        print(f'{s["name"]}: {s["entries"]} entries, {s["bytes"] / 1024 ** 2:.1f} MB')
+
+
+@cache.command()
+@click.option("--name", type=str, default=None)
+@click.option("--max-mb", type=float, default=None)
+def prune(name, max_mb):
+    # --max-mbを省略したら各キャッシュの既定の容量まで減らす
+    names = get_cache_names() if name is None else [name]
+    for n in names:
+        c = FileCache(n)
+        max_bytes = c.max_bytes if max_mb is None else int(max_mb * 1024 ** 2)
+        removed = c.prune(max_bytes)
+        print(f"{n}: removed {removed} entries (max {max_bytes / 1024 ** 2:.0f} MB)")
@@ -0,0 +1,84 @@
+import os
+import json
+import time
+
+from icecream import ic
+from tqdm import tqdm
+
+
+class RowJobRunner():
+    """
+    表の各行の処理結果を少しずつチェックポイント(JSON Lines)に追記し，
+    中断しても結果のある行を飛ばして再開できるようにする
+    各行は入力の値と一緒に保存し，入力が変わった行はやり直す
+    """
+    def __init__(self, checkpoint_filepath, batch_size=20, restart=False):
+        self.checkpoint_filepath = checkpoint_filepath
+        self.batch_size = max(1, batch_size)
+        if restart and os.path.exists(checkpoint_filepath):
+            os.remove(checkpoint_filepath)
+
+    @staticmethod
+    def for_output(output_filepath, **kwargs):
+        return RowJobRunner(f"{output_filepath}.ckpt.jsonl", **kwargs)
+
+    def exists(self):
+        return os.path.exists(self.checkpoint_filepath)
+
+    def _load(self):
+        done = dict()
+        if not self.exists():
+            return done
+        with open(self.checkpoint_filepath, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中で止まった最後の行
+                    continue
+                done[record["i"]] = (record["input"], record["value"])
+        return done
+
+    def run(self, inputs, process_batch, is_done=None):
+        """
+        inputs: 各行の入力(JSONにできる値)のリスト
+        process_batch: 入力のリストを受け取り，同じ順番で結果のリストを返す関数
+        is_done: 結果が確定したかを返す関数．確定していない結果(失敗など)の行は再開時にやり直す
+        全ての行の結果を行の順番で返す
+        """
+        inputs = list(inputs)
+        done = self._load()
+        results = [None] * len(inputs)
+        todo = list()
+        for i, x in enumerate(inputs):
+            if i in done and done[i][0] == x and (is_done is None or is_done(done[i][1])):
+                results[i] = done[i][1]
+            else:
+                todo.append(i)
+        ic(len(inputs), len(inputs) - len(todo))
+
+        begin = time.perf_counter()
+        with open(self.checkpoint_filepath, "a") as f, \
+                tqdm(total=len(todo)) as progress:
+            for j in range(0, len(todo), self.batch_size):
+                batch = todo[j:j + self.batch_size]
+                values = process_batch([inputs[i] for i in batch])
+                for i, value in zip(batch, values):
+                    results[i] = value
+                    f.write(json.dumps(
+                        {"i": i, "input": inputs[i], "value": value},
+                        ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+                progress.update(len(batch))
+                elapsed = time.perf_counter() - begin
+                rate = (j + len(batch)) / elapsed
+                progress.set_postfix(
+                        rows_per_sec=f"{rate:.2f}",
+                        eta_sec=f"{(len(todo) - j - len(batch)) / rate:.0f}")
+        return results
+
+    def finish(self):
+        """出力を書き終えたらチェックポイントを消す"""
+        if self.exists():
+            os.remove(self.checkpoint_filepath)
@@ -6,6 +6,8 @@ from .deck import deck
 from .diary import diary
 from .text import text
 from .image import image
+from .cache import cache
+from .translation import tm
 
 
 @click.group()
@@ -22,6 +24,8 @@ def main():
             diary,
             text,
             image,
+            cache,
+            tm,
             ]
     [
         ankihelper.add_command(c)
@@ -1,21 +1,31 @@
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from icecream import ic
 import click
 import pandas as pd
 import genanki
 import subprocess
-from tqdm import tqdm
 import numpy as np
+from yt_dlp import YoutubeDL
 
 from .utils import (
-        convert_vtt_time,
+        vtt_time_to_sec,
         parse_vtt,
         )
+from .video import (
+        extract_frames,
+        )
+from .pcm import (
+        get_pcm_cache,
+        cut_segments,
+        )
 from .deck_helper import (
         get_deck_helper_types,
         create_deck_helper,
+        MediaStore,
+        )
+from .media import (
+        get_image_formats,
         )
 
 @click.group()
@@ -31,12 +41,24 @@ def deck():
         type=click.Choice(get_deck_helper_types()),
         default=get_deck_helper_types()[0])
 @click.option("--model_id", type=int, default=12345678)
-def from_table(input_filepaths, output_filepath, deck_type, model_id):
+@click.option("--image-format", type=click.Choice(get_image_formats()), default=None)
+@click.option("--image-max-size", type=int, default=None)
+@click.option("--image-quality", type=int, default=80)
+def from_table(
+        input_filepaths,
+        output_filepath,
+        deck_type,
+        model_id,
+        image_format,
+        image_max_size,
+        image_quality):
     ic(input_filepaths, deck_type, model_id)
+    media_store = MediaStore(image_format, image_max_size, image_quality)
     deck_helper = create_deck_helper(
             deck_type,
             input_filepaths,
-            model_id)
+            model_id,
+            media_store)
     if deck_helper is None:
         print(f"{deck_type} is not supported")
         return
@@ -44,21 +66,21 @@ def from_table(input_filepaths, output_filepath, deck_type, model_id):
     deck = genanki.Deck(
             model_id,
             os.path.basename(output_filepath))
-    media_filepaths = list()
-    while (True):
-        try:
-            media_file, note = deck_helper.generate_note()
-        except Exception:
-            continue
-        if media_file is None or note is None:
-            break
-        deck.add_note(note)
-        media_filepaths.append(media_file)
-
-    package = genanki.Package(
-        deck,
-        media_files=media_filepaths)
-    package.write_to_file(f"{output_filepath}")
+    with media_store:
+        while (True):
+            try:
+                media_file, note = deck_helper.generate_note()
+            except Exception:
+                continue
+            if media_file is None or note is None:
+                break
+            deck.add_note(note)
+
+        # ノートが参照するメディアだけを，同じ内容なら一つだけ入れる
+        package = genanki.Package(
+            deck,
+            media_files=media_store.media_files())
+        package.write_to_file(f"{output_filepath}")
     ic(output_filepath)
 
 
@@ -77,33 +99,22 @@ def from_audio_and_vtt(audio_filepath, vtt_filepath, audio_offset_sec_start, aud
 
     matches = parse_vtt(vtt_filepath)
 
-    def process_section(idx, start, end, text, audio_offset=0, image_offset=0):
-        text = text.strip()
-        output_audio = os.path.join(AUDIO_CLIPS_DIR, f"audio-{idx}.mp3")
-
-        start_audio = convert_vtt_time(start, offset=audio_offset_sec_start)
-        end_audio   = convert_vtt_time(end, offset=audio_offset_sec_end)
-
-        subprocess.run([
-            "ffmpeg", "-i", AUDIO_FILE,
-            "-ss", start_audio, "-to", end_audio,
-            "-q:a", "0", "-map", "a", "-f", "mp3", output_audio, "-y"
-        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-        return idx, (os.path.basename(output_audio), text)
-
-    cards = []
     print("⚙️ 音声クリップを生成中...")
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        futures = []
-        for idx, (start, end, text) in enumerate(matches):
-            futures.append(executor.submit(process_section, idx, start, end, text))
-        for future in tqdm(as_completed(futures), total=len(futures)):
-            try:
-                result = future.result()
-                cards.append(result)
-            except Exception as e:
-                print("Error processing a section:", e)
+    output_audios = [
+            os.path.join(AUDIO_CLIPS_DIR, f"audio-{idx}.mp3")
+            for idx in range(len(matches))]
+    done = cut_segments(
+            AUDIO_FILE,
+            [
+                (
+                    vtt_time_to_sec(start, offset=audio_offset_sec_start),
+                    vtt_time_to_sec(end, offset=audio_offset_sec_end))
+                for start, end, _ in matches],
+            output_audios,
+            cache=get_pcm_cache())
+    cards = [
+            (idx, (os.path.basename(output_audios[idx]), matches[idx][2].strip()))
+            for idx in done]
 
     print(f"✅ {len(cards)} 個のセクションを処理しました！")
 
@@ -126,20 +137,20 @@ def from_audio_and_vtt(audio_filepath, vtt_filepath, audio_offset_sec_start, aud
     )
 
     deck = genanki.Deck(np.random.randint(0, int(1e10)), audio_name)
-    for _, (audio, text) in sorted(cards):
-        note = genanki.Note(
-            model=model,
-            fields=[audio.replace(audio, f"[sound:{audio}]"), text]
-        )
-        deck.add_note(note)
-
     output_apkg = os.path.join(work_dir, f"{audio_name}.apkg")
-    package = genanki.Package(
-        deck,
-        media_files=
-            [os.path.join(AUDIO_CLIPS_DIR, f) for f in os.listdir(AUDIO_CLIPS_DIR)]
-    )
-    package.write_to_file(output_apkg)
+    with MediaStore() as media_store:
+        for _, (audio, text) in sorted(cards):
+            note = genanki.Note(
+                model=model,
+                fields=[media_store.sound(os.path.join(AUDIO_CLIPS_DIR, audio)), text]
+            )
+            deck.add_note(note)
+
+        package = genanki.Package(
+            deck,
+            media_files=media_store.media_files()
+        )
+        package.write_to_file(output_apkg)
 
     print("🎉 Ankiデッキ作成完了！")
     print(f"📦 出力ファイル: {output_apkg}")
@@ -152,11 +163,17 @@ def from_audio_and_vtt(audio_filepath, vtt_filepath, audio_offset_sec_start, aud
 @click.option("-aos", "--audio-offset-sec_start", type=float, default=0.)
 @click.option("-aoe", "--audio-offset-sec_end", type=float, default=0.)
 @click.option("-ios", "--image-offset-sec-start", type=float, default=0.)
+@click.option("--image-format", type=click.Choice(get_image_formats()), default=None)
+@click.option("--image-max-size", type=int, default=None)
+@click.option("--image-quality", type=int, default=80)
 def from_web_video(
         url,
         audio_offset_sec_start,
         audio_offset_sec_end,
-        image_offset_sec_start):
+        image_offset_sec_start,
+        image_format,
+        image_max_size,
+        image_quality):
     movie_name = url.split("/")[-1]
     work_dir = f"/tmp/{movie_name}"
     os.makedirs(work_dir, exist_ok=True)
@@ -165,11 +182,6 @@ def from_web_video(
     AUDIO_FILE = os.path.join(work_dir, "audio.mp3")
     SUBTITLE_FILE = os.path.join(work_dir, "subtitle.vtt")
 
-    AUDIO_CLIPS_DIR = os.path.join(work_dir, "audio_clips")
-    SCREENSHOTS_DIR = os.path.join(work_dir, "screenshots")
-    os.makedirs(AUDIO_CLIPS_DIR, exist_ok=True)
-    os.makedirs(SCREENSHOTS_DIR, exist_ok=True)
-
     if os.path.exists(VIDEO_FILE) and os.path.exists(AUDIO_FILE) and os.path.exists(SUBTITLE_FILE):
         pass
     else:
@@ -205,40 +217,111 @@ def from_web_video(
     print(f"🔹 音声: {'OK' if os.path.exists(AUDIO_FILE) else '❌'}")
     print(f"🔹 字幕: {'OK' if os.path.exists(SUBTITLE_FILE) else '❌'}")
 
-    matches = parse_vtt(SUBTITLE_FILE)
-
-    def process_section(idx, start, end, text, audio_offset=0, image_offset=0):
-        """各セクションについて音声クリップとスクリーンショットを生成する"""
-        text = text.strip()
-        output_audio = os.path.join(AUDIO_CLIPS_DIR, f"audio-{idx}.mp3")
-        output_image = os.path.join(SCREENSHOTS_DIR, f"image-{idx}.jpg")
-        start_audio = convert_vtt_time(start, offset=audio_offset_sec_start)
-        end_audio   = convert_vtt_time(end, offset=audio_offset_sec_end)
-        start_image = convert_vtt_time(start, offset=image_offset_sec_start)
-        subprocess.run([
-            "ffmpeg", "-i", AUDIO_FILE,
-            "-ss", start_audio, "-to", end_audio,
-            "-q:a", "0", "-map", "a", "-f", "mp3", output_audio, "-y"
-        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        subprocess.run([
-            "ffmpeg", "-i", VIDEO_FILE,
-            "-ss", start_image, "-vframes", "1",
-            "-f", "image2", output_image, "-y"
-        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return idx, (text, os.path.basename(output_audio), os.path.basename(output_image))
-
-    cards = []
-    print("⚙️ 音声クリップとスクリーンショットを生成中...")
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        futures = []
-        for idx, (start, end, text) in enumerate(matches):
-            futures.append(executor.submit(process_section, idx, start, end, text))
-        for future in tqdm(as_completed(futures), total=len(futures)):
-            try:
-                result = future.result()
-                cards.append(result)
-            except Exception as e:
-                print("Error processing a section:", e)
+    create_video_deck(
+            work_dir,
+            movie_name,
+            VIDEO_FILE,
+            AUDIO_FILE,
+            SUBTITLE_FILE,
+            audio_offset_sec_start,
+            audio_offset_sec_end,
+            image_offset_sec_start,
+            image_format,
+            image_max_size,
+            image_quality)
+
+
+@deck.command()
+@click.argument("video_filepath", type=str)
+@click.argument("vtt_filepath", type=str)
+@click.option("-aos", "--audio-offset-sec_start", type=float, default=0.)
+@click.option("-aoe", "--audio-offset-sec_end", type=float, default=0.)
+@click.option("-ios", "--image-offset-sec-start", type=float, default=0.)
+@click.option("--image-format", type=click.Choice(get_image_formats()), default=None)
+@click.option("--image-max-size", type=int, default=None)
+@click.option("--image-quality", type=int, default=80)
+def from_local_video(
+        video_filepath,
+        vtt_filepath,
+        audio_offset_sec_start,
+        audio_offset_sec_end,
+        image_offset_sec_start,
+        image_format,
+        image_max_size,
+        image_quality):
+    movie_name = os.path.basename(video_filepath).split(".")[0]
+    work_dir = f"/tmp/{movie_name}"
+    os.makedirs(work_dir, exist_ok=True)
+
+    # 音声は動画から直接切り出す
+    create_video_deck(
+            work_dir,
+            movie_name,
+            video_filepath,
+            video_filepath,
+            vtt_filepath,
+            audio_offset_sec_start,
+            audio_offset_sec_end,
+            image_offset_sec_start,
+            image_format,
+            image_max_size,
+            image_quality)
+
+
+def create_video_deck(
+        work_dir,
+        movie_name,
+        video_filepath,
+        audio_filepath,
+        vtt_filepath,
+        audio_offset_sec_start,
+        audio_offset_sec_end,
+        image_offset_sec_start,
+        image_format=None,
+        image_max_size=None,
+        image_quality=80):
+    AUDIO_CLIPS_DIR = os.path.join(work_dir, "audio_clips")
+    SCREENSHOTS_DIR = os.path.join(work_dir, "screenshots")
+    os.makedirs(AUDIO_CLIPS_DIR, exist_ok=True)
+    os.makedirs(SCREENSHOTS_DIR, exist_ok=True)
+
+    matches = parse_vtt(vtt_filepath)
+    output_audios = [
+            os.path.join(AUDIO_CLIPS_DIR, f"audio-{idx}.mp3")
+            for idx in range(len(matches))]
+    output_images = [
+            os.path.join(SCREENSHOTS_DIR, f"image-{idx}.jpg")
+            for idx in range(len(matches))]
+
+    # 音声も画像もソースのデコードは一度だけ
+    print("⚙️ 音声クリップを生成中...")
+    audio_done = cut_segments(
+            audio_filepath,
+            [
+                (
+                    vtt_time_to_sec(start, offset=audio_offset_sec_start),
+                    vtt_time_to_sec(end, offset=audio_offset_sec_end))
+                for start, end, _ in matches],
+            output_audios,
+            cache=get_pcm_cache())
+
+    print("⚙️ スクリーンショットを生成中...")
+    image_done = extract_frames(
+            video_filepath,
+            [
+                vtt_time_to_sec(start, offset=image_offset_sec_start)
+                for start, _, _ in matches],
+            output_images)
+
+    done = sorted(set(audio_done) & set(image_done))
+    cards = [
+            (
+                idx,
+                (
+                    matches[idx][2].strip(),
+                    os.path.basename(output_audios[idx]),
+                    os.path.basename(output_images[idx])))
+            for idx in done]
 
     print(f"✅ {len(cards)} 個のセクションを処理しました！")
 
@@ -263,26 +346,26 @@ def from_web_video(
     )
 
     deck = genanki.Deck(987654321, movie_name)
-    for _, (text, audio, image) in sorted(cards):
-        print(image, audio)
-        note = genanki.Note(
-            model=model,
-            fields=[image.replace(image, f'<img src="{image}">'), audio.replace(audio, f"[sound:{audio}]"), text]
-        )
-        deck.add_note(note)
-
     output_apkg = os.path.join(work_dir, f"{movie_name}.apkg")
-    package = genanki.Package(
-        deck,
-        media_files=
-            [os.path.join(AUDIO_CLIPS_DIR, f) for f in os.listdir(AUDIO_CLIPS_DIR)]
-            + [os.path.join(SCREENSHOTS_DIR, f) for f in os.listdir(SCREENSHOTS_DIR)]
-    )
-    package.write_to_file(output_apkg)
+    with MediaStore(image_format, image_max_size, image_quality) as media_store:
+        for _, (text, audio, image) in sorted(cards):
+            print(image, audio)
+            note = genanki.Note(
+                model=model,
+                fields=[
+                    media_store.img(os.path.join(SCREENSHOTS_DIR, image)),
+                    media_store.sound(os.path.join(AUDIO_CLIPS_DIR, audio)),
+                    text]
+            )
+            deck.add_note(note)
+
+        package = genanki.Package(
+            deck,
+            media_files=media_store.media_files()
+        )
+        package.write_to_file(output_apkg)
 
     print("🎉 Ankiデッキ作成完了！")
     print(f"📦 出力ファイル: {output_apkg}")
 
     subprocess.run(["reset"])
-
-
@@ -1,34 +1,181 @@
 import os
+import ast
+import shutil
+import tempfile
 
 import genanki
 import pandas as pd
 
+from .cache import (
+        hash_bytes,
+        hash_file,
+        )
+from .media import (
+        EXT_BY_IMAGE_FORMAT,
+        encode_images,
+        is_image,
+        )
+
+
+class MediaStore():
+    """
+    ノートが参照するメディアだけを，内容のハッシュをファイル名としてまとめる
+    同じ内容のファイルは一つだけパッケージに入る
+    image_formatを指定すると，画像はパッケージにする前にまとめて縮小・再エンコードする
+    """
+    def __init__(
+            self,
+            image_format=None,
+            image_max_size=None,
+            image_quality=80,
+            num_workers=os.cpu_count()):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self._name_by_filepath = dict()
+        self._filepath_by_name = dict()
+        self.image_format = image_format
+        self.image_max_size = image_max_size
+        self.image_quality = image_quality
+        self.num_workers = num_workers
+        self._pending_images = list()
+
+    def add(self, filepath):
+        """ノートのフィールドに書くファイル名を返す"""
+        if filepath in self._name_by_filepath:
+            return self._name_by_filepath[filepath]
+        encode = self.image_format is not None and is_image(filepath)
+        if encode:
+            ext = EXT_BY_IMAGE_FORMAT[self.image_format]
+        else:
+            ext = os.path.splitext(filepath)[1]
+        name = f"{hash_file(filepath)[:32]}{ext}"
+        if name not in self._filepath_by_name:
+            dst = os.path.join(self._tmp_dir.name, name)
+            if encode:
+                # 変換はmedia_filesでまとめて行う
+                self._pending_images.append((filepath, dst))
+            else:
+                try:
+                    os.link(filepath, dst)
+                except OSError:
+                    shutil.copyfile(filepath, dst)
+            self._filepath_by_name[name] = dst
+        self._name_by_filepath[filepath] = name
+        return name
+
+    def sound(self, filepath):
+        return f"[sound:{self.add(filepath)}]"
+
+    def img(self, filepath):
+        return f'<img src="{self.add(filepath)}">'
+
+    def media_files(self):
+        if len(self._pending_images) > 0:
+            encode_images(
+                    [src for src, _ in self._pending_images],
+                    [dst for _, dst in self._pending_images],
+                    max_size=self.image_max_size,
+                    format=self.image_format,
+                    quality=self.image_quality,
+                    num_workers=self.num_workers)
+            self._pending_images = list()
+        return list(self._filepath_by_name.values())
+
+    def cleanup(self):
+        self._tmp_dir.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.cleanup()
+
 
 def get_deck_helper_types():
     return ["listening", "reading_question", "writing"]
 
 
-def create_deck_helper(type_, input_filepaths, model_id):
+def create_deck_helper(type_, input_filepaths, model_id, media_store=None):
     if type_ not in get_deck_helper_types():
         return None
 
     if type_ == "listening":
-        return ListeningDeckHelper(input_filepaths, model_id)
+        return ListeningDeckHelper(input_filepaths, model_id, media_store)
     elif type_ == "reading_question":
-        return ReadingQuestionDeckHelper(input_filepaths, model_id)
+        return ReadingQuestionDeckHelper(input_filepaths, model_id, media_store)
     elif type_ == "writing":
-        return WritingDeckHelper(input_filepaths, model_id)
+        return WritingDeckHelper(input_filepaths, model_id, media_store)
 
 
 class DeckHelper():
-    def __init__(self, input_filepaths, model_id):
-        self._dfs = [
-                pd.read_csv(
-                    input_filepath, header=0, usecols=self._get_cols())
-                for input_filepath in input_filepaths]
+    """
+    表に画像の列(table add-imageの出力)があれば，Imageフィールドを加えて裏面に画像を出す
+    """
+    IMAGE_COL = "image"
+
+    def __init__(self, input_filepaths, model_id, media_store=None):
+        self._dfs = list()
+        for input_filepath in input_filepaths:
+            # 必要な列がなければread_csvがValueErrorを出す
+            cols = self._get_cols()
+            if self.IMAGE_COL in pd.read_csv(input_filepath, nrows=0).columns:
+                cols = cols + [self.IMAGE_COL]
+            self._dfs.append(pd.read_csv(input_filepath, header=0, usecols=cols))
+        self._has_image = any([self.IMAGE_COL in df.columns for df in self._dfs])
         self.model_id = model_id
+        self._media_store = media_store
         self._gen = self._extract_row()
 
+    def _sound(self, filepath):
+        if self._media_store is not None:
+            return self._media_store.sound(filepath)
+        filename = os.path.basename(filepath)
+        return f"[sound:{filename}]"
+
+    def _img(self, filepath):
+        if self._media_store is not None:
+            return self._media_store.img(filepath)
+        filename = os.path.basename(filepath)
+        return f'<img src="{filename}">'
+
+    def _image_field(self, row):
+        # add-imageの出力は各行が画像のパスのリスト
+        value = getattr(row, self.IMAGE_COL, None)
+        if not isinstance(value, str):
+            return ""
+        filepaths = ast.literal_eval(value) if value.startswith("[") else [value]
+        return "".join([self._img(filepath) for filepath in filepaths])
+
+    def _image_model_id(self):
+        """
+        Ankiはidでノートタイプを区別するので，フィールドの違う画像付きは別のidにする
+        同じmodel_idからは常に同じidになる
+        """
+        h = int(hash_bytes(f"{self.model_id}:{self.IMAGE_COL}".encode("utf-8"))[:8], 16)
+        return (1 << 30) + h % (1 << 30)
+
+    def _create_model(self, template, fields):
+        model_id = self.model_id
+        name = template["name"]
+        if self._has_image:
+            model_id = self._image_model_id()
+            name = f"{name} (Image)"
+            fields = fields + [{"name": "Image"}]
+            template = dict(
+                    template,
+                    afmt=template["afmt"] + "{{#Image}}<hr>{{Image}}{{/Image}}")
+        return genanki.Model(
+                model_id,
+                name,
+                fields=fields,
+                templates=[template])
+
+    def _create_note(self, row, fields):
+        if self._has_image:
+            fields = fields + [self._image_field(row)]
+        return genanki.Note(
+                model=self._generate_model(),
+                fields=fields)
+
     def _extract_row(self):
         for df in self._dfs:
             for row in df.itertuples():
@@ -54,8 +201,8 @@ class DeckHelper():
 
 
 class ListeningDeckHelper(DeckHelper):
-    def __init__(self, input_filepaths, model_id):
-        super().__init__(input_filepaths, model_id)
+    def __init__(self, input_filepaths, model_id, media_store=None):
+        super().__init__(input_filepaths, model_id, media_store)
 
     def _get_cols(self):
         return ["en", "ja", "en_audio"]
@@ -67,33 +214,30 @@ class ListeningDeckHelper(DeckHelper):
                 "afmt": '{{FrontSide}}<hr>{{EN}}<hr>{{JP}}<hr>{{MEMO}}'
             }
 
-        return genanki.Model(
-                self.model_id,
-                template["name"],
-                fields=[
+        return self._create_model(
+                template,
+                [
                     {"name": "JP"},
                     {"name": "EN"},
                     {"name": "Audio"},
                     {"name": "MEMO"},
-                    ],
-                templates=[template])
+                ])
 
     def _generate_note(self, row):
         if row.ja == "Error":
             raise Exception("An error in row.ja")
-        audio_filename = os.path.basename(row.en_audio)
-        return row.en_audio, genanki.Note(
-            model=self._generate_model(),
-            fields=[
+        return row.en_audio, self._create_note(
+            row,
+            [
                 row.ja,
                 row.en,
-                audio_filename.replace(audio_filename, f"[sound:{audio_filename}]"),
+                self._sound(row.en_audio),
                 ""])
 
 
 class ReadingQuestionDeckHelper(DeckHelper):
-    def __init__(self, input_filepaths, model_id):
-        super().__init__(input_filepaths, model_id)
+    def __init__(self, input_filepaths, model_id, media_store=None):
+        super().__init__(input_filepaths, model_id, media_store)
 
     def _get_cols(self):
         return ["q", "opt", "en", "ja", "exp", "en_audio"]
@@ -105,10 +249,9 @@ class ReadingQuestionDeckHelper(DeckHelper):
                 "afmt": '{{FrontSide}}<hr>{{AUDIO}}<hr>{{EN}}<hr>{{JP}}<hr>{{EXP}}<hr>{{MEMO}}'
             }
 
-        return genanki.Model(
-                self.model_id,
-                template["name"],
-                fields=[
+        return self._create_model(
+                template,
+                [
                     {"name": "Q"},
                     {"name": "OPT"},
                     {"name": "AUDIO"},
@@ -116,17 +259,15 @@ class ReadingQuestionDeckHelper(DeckHelper):
                     {"name": "JP"},
                     {"name": "EXP"},
                     {"name": "MEMO"},
-                    ],
-                templates=[template])
+                ])
 
     def _generate_note(self, row):
-        audio_filename = os.path.basename(row.en_audio)
-        return row.en_audio, genanki.Note(
-            model=self._generate_model(),
-            fields=[
+        return row.en_audio, self._create_note(
+            row,
+            [
                 row.q,
                 row.opt,
-                audio_filename.replace(audio_filename, f"[sound:{audio_filename}]"),
+                self._sound(row.en_audio),
                 row.en,
                 row.ja,
                 row.exp,
@@ -134,8 +275,8 @@ class ReadingQuestionDeckHelper(DeckHelper):
 
 
 class WritingDeckHelper(DeckHelper):
-    def __init__(self, input_filepaths, model_id):
-        super().__init__(input_filepaths, model_id)
+    def __init__(self, input_filepaths, model_id, media_store=None):
+        super().__init__(input_filepaths, model_id, media_store)
 
     def _get_cols(self):
         return ["en", "ja", "en_audio"]
@@ -147,23 +288,20 @@ class WritingDeckHelper(DeckHelper):
                 "afmt": '{{FrontSide}}<hr>{{AUDIO}}<hr>{{EN}}<hr>{{MEMO}}'
             }
 
-        return genanki.Model(
-                self.model_id,
-                template["name"],
-                fields=[
+        return self._create_model(
+                template,
+                [
                     {"name": "JP"},
                     {"name": "AUDIO"},
                     {"name": "EN"},
                     {"name": "MEMO"},
-                    ],
-                templates=[template])
+                ])
 
     def _generate_note(self, row):
-        audio_filename = os.path.basename(row.en_audio)
-        return row.en_audio, genanki.Note(
-            model=self._generate_model(),
-            fields=[
+        return row.en_audio, self._create_note(
+            row,
+            [
                 row.ja,
-                audio_filename.replace(audio_filename, f"[sound:{audio_filename}]"),
+                self._sound(row.en_audio),
                 row.en,
                 ""])
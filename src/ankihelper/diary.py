@@ -3,11 +3,17 @@ import os
 import shutil
 
 import click
-from gtts import gTTS
 from icecream import ic
 import torch
 from diffusers import StableDiffusionPipeline
 
+from .utils import (
+        get_tts_types,
+        )
+from .tts import (
+        CachedTTS,
+        )
+
 
 @click.group()
 def diary():
@@ -17,7 +23,8 @@ def diary():
 @diary.command()
 @click.argument("text", type=str)
 @click.option("--image-size", type=int, default=400)
-def add(text, image_size):
+@click.option("--tts", "tts_type", type=click.Choice(get_tts_types()), default="gtts")
+def add(text, image_size, tts_type):
     # 作業ディレクトリの準備
     now = date_str = datetime.now().strftime("%Y%m%d%H%M")
     dirpath = f"/tmp/diary/{now}"
@@ -29,8 +36,9 @@ def add(text, image_size):
         [f.write(f"{t}.\n") for t in text.split(". ")]
 
     ic("generate audio...")
-    tts = gTTS(text, lang='en')
-    tts.save(os.path.join(dirpath, "audio.mp3"))
+    tts = CachedTTS(tts_type)
+    tts.save(text, 'en', os.path.join(dirpath, "audio.mp3"))
+    tts.report()
 
     ic("generate image...")
     pipe = StableDiffusionPipeline.from_pretrained(
@@ -0,0 +1,119 @@
+import io
+import time
+
+from .utils import (
+        ImageGenerator,
+        get_default_num_inference_steps,
+        )
+from .cache import (
+        FileCache,
+        make_key,
+        link_or_copy,
+        get_default_max_bytes,
+        )
+
+
+IMAGE_CACHE_MAX_BYTES = get_default_max_bytes("image")
+
+
+def get_image_cache(max_bytes=IMAGE_CACHE_MAX_BYTES):
+    return FileCache("image", max_bytes=max_bytes)
+
+
+class CachedImageGenerator():
+    """
+    (モデル, プロファイル, プロンプト, ネガティブプロンプト, seed, 幅, 高さ, ステップ数) をキーに
+    生成した画像を保存しておき，同じ条件の画像は生成せずに再利用する
+    パイプラインはキャッシュにない画像を生成する時に初めてロードする
+    """
+    def __init__(self, model_id, safety=True, cache=None, profile="default", compile=False):
+        self.model_name = ImageGenerator.get_diffuser_model_name_by_id()[model_id]
+        self.safety = safety
+        self.profile = profile
+        self.compile = compile
+        self.cache = get_image_cache() if cache is None else cache
+        self._gen = None
+        self.num_generated = 0
+        self.generate_sec = 0.
+
+    def _generator(self):
+        if self._gen is None:
+            self._gen = ImageGenerator(
+                    self.model_name, self.safety, self.profile, self.compile)
+        return self._gen
+
+    def _key(self, prompt, negative_prompt, seed, width, height, num_inference_steps):
+        # スケジューラが変わるとプロファイル毎に画像も変わる
+        return make_key(
+                self.model_name, self.safety, self.profile, prompt, negative_prompt,
+                seed, width, height, num_inference_steps)
+
+    def generate_to_files(
+            self,
+            prompts,
+            output_filepaths,
+            height,
+            width,
+            negative_prompt="ext, letters, words, watermark, negative",
+            num_inference_steps=None,
+            seed=None):
+        """
+        各プロンプトの画像をJPEGで出力先に書き出す
+        seedがNoneなら同じ画像にならないのでキャッシュを使わない
+        """
+        if num_inference_steps is None:
+            num_inference_steps = get_default_num_inference_steps(self.profile)
+        keys = [
+                self._key(p, negative_prompt, seed, width, height, num_inference_steps)
+                for p in prompts]
+        misses = [
+                i for i, key in enumerate(keys)
+                if seed is None or self.cache.get(key, ".jpg") is None]
+        if len(misses) > 0:
+            begin = time.perf_counter()
+            images = self._generator().generate(
+                    [prompts[i] for i in misses],
+                    height=height,
+                    width=width,
+                    negative_prompt=negative_prompt,
+                    num_inference_steps=num_inference_steps,
+                    seed=seed)
+            self.generate_sec += time.perf_counter() - begin
+            self.num_generated += len(images)
+            for i, img in zip(misses, images):
+                if seed is None:
+                    img.save(output_filepaths[i], format="JPEG")
+                    continue
+                buf = io.BytesIO()
+                img.save(buf, format="JPEG")
+                self.cache.put_bytes(keys[i], buf.getvalue(), ".jpg")
+        for i, key in enumerate(keys):
+            if seed is not None:
+                link_or_copy(self.cache.path(key, ".jpg"), output_filepaths[i])
+        return list(output_filepaths)
+
+    def report(self):
+        self.cache.report()
+        if self.num_generated > 0:
+            print(
+                f"{self.num_generated} images generated in {self.generate_sec:.1f} sec "
+                f"({self.num_generated / self.generate_sec:.3f} images/sec)")
+        self.cache.prune()
+
+
+def benchmark_image_generation(
+        model_name,
+        profile,
+        prompts,
+        height,
+        width,
+        compile=False,
+        batch_size=1):
+    """キャッシュを使わずに生成し，1枚あたりの秒数を返す"""
+    gen = ImageGenerator(model_name, safety=False, profile=profile, compile=compile)
+    # ロードや torch.compile の初回は計測に含めない
+    gen.generate(prompts[0], height, width, seed=0)
+    begin = time.perf_counter()
+    for i in range(0, len(prompts), batch_size):
+        gen.generate(prompts[i:i + batch_size], height, width, seed=0)
+    return (time.perf_counter() - begin) / len(prompts)
@@ -4,6 +4,11 @@ from icecream import ic
 import click
 from .utils import (
         ImageGenerator,
+        get_image_profiles,
+        )
+from .diffusion import (
+        CachedImageGenerator,
+        benchmark_image_generation,
         )
 
 
@@ -24,6 +29,10 @@ def image(ctx):
 @click.option("--image-height", type=int, default=480)
 @click.option("--output-dir-path", "-o", type=str, default="/tmp")
 @click.option("--safety", is_flag=True, default=False)
+@click.option("--num-inference-steps", type=int, default=None)
+@click.option("--seed", type=int, default=0)
+@click.option("--profile", type=click.Choice(get_image_profiles()), default="default")
+@click.option("--compile", is_flag=True, default=False)
 @click.pass_context
 def from_text(
         ctx,
@@ -32,19 +41,55 @@ def from_text(
         image_width,
         image_height,
         output_dir_path,
-        safety):
-    gen = ImageGenerator(
-            ImageGenerator.get_diffuser_model_name_by_id()[model_id],
-            safety)
-
-    images = gen.generate(
-            text, image_height, image_width)
+        safety,
+        num_inference_steps,
+        seed,
+        profile,
+        compile):
+    gen = CachedImageGenerator(model_id, safety, profile=profile, compile=compile)
 
-    for i, img in enumerate(images):
-        imgpath = os.path.join(output_dir_path, f"image_{i:02d}.jpg")
-        img.save(imgpath, format="JPEG")
+    imgpath = os.path.join(output_dir_path, "image_00.jpg")
+    gen.generate_to_files(
+            [text], [imgpath], image_height, image_width,
+            num_inference_steps=num_inference_steps,
+            seed=seed)
+    gen.report()
+    ic(imgpath)
 
 
 @image.command()
 def show_model_name_by_id():
     ic(ImageGenerator.get_diffuser_model_name_by_id())
+
+
+@image.command()
+@click.option(
+        "--model-id",
+        "model_ids",
+        type=click.Choice(list(ImageGenerator.get_diffuser_model_name_by_id().keys())),
+        multiple=True)
+@click.option("--profile", "profiles", type=click.Choice(get_image_profiles()), multiple=True)
+@click.option("--image-size", type=int, default=240)
+@click.option("--num-images", type=int, default=4)
+@click.option("--batch-size", type=int, default=1)
+@click.option("--compile", is_flag=True, default=False)
+def benchmark(model_ids, profiles, image_size, num_images, batch_size, compile):
+    """プロファイルとモデル毎に1枚あたりの生成時間を測る"""
+    if len(model_ids) == 0:
+        model_ids = ["0"]
+    if len(profiles) == 0:
+        profiles = get_image_profiles()
+    prompts = [
+            f'The atmosphere associated with the English sentence "sentence {i}"'
+            for i in range(num_images)]
+    results = list()
+    for model_id in model_ids:
+        model_name = ImageGenerator.get_diffuser_model_name_by_id()[model_id]
+        for profile in profiles:
+            sec = benchmark_image_generation(
+                    model_name, profile, prompts, image_size, image_size,
+                    compile=compile, batch_size=batch_size)
+            results.append((model_id, profile, sec))
+            ic(model_name, profile, sec)
+    for model_id, profile, sec in results:
+        print(f"model {model_id} {profile}: {sec:.2f} sec/image")
@@ -0,0 +1,71 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+from tqdm import tqdm
+
+
+IMAGE_EXTS = [".jpg", ".jpeg", ".png", ".webp", ".bmp"]
+
+EXT_BY_IMAGE_FORMAT = {
+        "webp": ".webp",
+        "jpeg": ".jpg",
+        }
+
+
+def get_image_formats():
+    return list(EXT_BY_IMAGE_FORMAT.keys())
+
+
+def is_image(filepath):
+    return os.path.splitext(filepath)[1].lower() in IMAGE_EXTS
+
+
+def encode_image(src_filepath, dst_filepath, max_size=None, format="webp", quality=80):
+    """
+    長辺がmax_size以下になるように縮小し，指定した形式と品質で保存する
+    (元のバイト数, 保存後のバイト数) を返す
+    """
+    with Image.open(src_filepath) as image:
+        image = image.convert("RGB")
+        if max_size is not None and max(image.size) > max_size:
+            image.thumbnail((max_size, max_size), Image.LANCZOS)
+        if format == "webp":
+            image.save(dst_filepath, format="WEBP", quality=quality, method=6)
+        else:
+            image.save(dst_filepath, format="JPEG", quality=quality, optimize=True)
+    return os.path.getsize(src_filepath), os.path.getsize(dst_filepath)
+
+
+def encode_images(
+        src_filepaths,
+        dst_filepaths,
+        max_size=None,
+        format="webp",
+        quality=80,
+        num_workers=os.cpu_count()):
+    """複数の画像を複数プロセスで変換し，減ったバイト数を表示する"""
+    if len(src_filepaths) == 0:
+        return []
+    begin = time.perf_counter()
+    n = len(src_filepaths)
+    with ProcessPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        sizes = list(tqdm(
+            executor.map(
+                encode_image,
+                src_filepaths,
+                dst_filepaths,
+                [max_size] * n,
+                [format] * n,
+                [quality] * n,
+                chunksize=max(1, n // (4 * max(1, num_workers)))),
+            total=n))
+    src_bytes = sum([s for s, _ in sizes])
+    dst_bytes = sum([d for _, d in sizes])
+    elapsed = time.perf_counter() - begin
+    print(
+        f"{n} images: {src_bytes / 1024 ** 2:.1f} MB -> {dst_bytes / 1024 ** 2:.1f} MB "
+        f"(saved {(src_bytes - dst_bytes) / 1024 ** 2:.1f} MB, "
+        f"{100 * (1 - dst_bytes / max(1, src_bytes)):.0f}%) in {elapsed:.1f} sec")
+    return sizes
@@ -0,0 +1,35 @@
+def pack_texts(texts, max_chars):
+    """改行で繋いだときにmax_chars文字を超えないようにテキストをまとめる"""
+    packs = list()
+    pack = list()
+    num_chars = 0
+    for text in texts:
+        if len(pack) > 0 and num_chars + len(text) + 1 > max_chars:
+            packs.append(pack)
+            pack = list()
+            num_chars = 0
+        pack.append(text)
+        num_chars += len(text) + 1
+    if len(pack) > 0:
+        packs.append(pack)
+    return packs
+
+
+def split_translated_lines(translated, num_lines):
+    """
+    改行で繋いで翻訳した結果(googletransのTranslated)を元の文の数に分け直す
+    .textは訳の部分を空白か空文字で繋ぐので，部分の境目にあった改行が残る保証がない．
+    そこで部分をそのまま繋いだものを改行で分ける
+    部分の数を文の数とみなすと，複数の文からなる行でずれても気付けないので使わない
+    分け直せなければNoneを返す
+    """
+    parts = (translated.extra_data or {}).get("parts") or []
+    texts = [
+        "".join([part.text for part in parts]) if len(parts) > 0 else translated.text,
+        translated.text,
+        ]
+    for text in texts:
+        lines = [line.strip() for line in text.split("\n") if line.strip() != ""]
+        if len(lines) == num_lines:
+            return lines
+    return None
@@ -0,0 +1,194 @@
+import os
+import json
+import shutil
+import struct
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from icecream import ic
+from tqdm import tqdm
+import numpy as np
+
+from .cache import (
+        FileCache,
+        make_key,
+        get_default_max_bytes,
+        )
+
+
+def probe_audio(filepath):
+    """ffprobeで最初の音声ストリームのサンプルレートとチャンネル数を得る"""
+    out = subprocess.run([
+        "ffprobe", "-v", "error",
+        "-select_streams", "a:0",
+        "-show_entries", "stream=sample_rate,channels",
+        "-of", "json", filepath,
+    ], capture_output=True, check=True).stdout
+    stream = json.loads(out)["streams"][0]
+    return int(stream["sample_rate"]), int(stream["channels"])
+
+
+def iter_pcm_blocks(
+        filepath,
+        block_sec=30.,
+        sample_rate=None,
+        channels=None,
+        resample=False):
+    """
+    ffmpegでデコードしたPCM(int16)を固定長のブロックで順に返す
+    各ブロックは (フレーム数, チャンネル数) の配列
+    resample=Trueならsample_rate, channelsに変換してデコードする
+    """
+    convert = list()
+    if resample:
+        convert = ["-ar", str(sample_rate), "-ac", str(channels)]
+    elif sample_rate is None or channels is None:
+        sample_rate, channels = probe_audio(filepath)
+    proc = subprocess.Popen([
+        "ffmpeg", "-v", "error", "-i", filepath,
+        "-map", "a:0", *convert, "-f", "s16le", "-acodec", "pcm_s16le", "-",
+    ], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    bytes_per_frame = 2 * channels
+    block_bytes = int(block_sec * sample_rate) * bytes_per_frame
+    rest = b""
+    try:
+        while True:
+            data = proc.stdout.read(block_bytes)
+            if not data:
+                break
+            data = rest + data
+            usable = len(data) - len(data) % bytes_per_frame
+            rest = data[usable:]
+            yield np.frombuffer(data[:usable], dtype=np.int16).reshape(-1, channels)
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+
+PCM_MAGIC = b"AHPCM1"
+PCM_HEADER_SIZE = 64
+PCM_CACHE_MAX_BYTES = get_default_max_bytes("pcm")
+
+
+def get_pcm_cache(max_bytes=PCM_CACHE_MAX_BYTES):
+    return FileCache("pcm", max_bytes=max_bytes)
+
+
+def _pcm_header(sample_rate, channels, dtype="<i2"):
+    header = PCM_MAGIC + struct.pack("<IH8s", sample_rate, channels, dtype.encode())
+    return header.ljust(PCM_HEADER_SIZE, b"\0")
+
+
+def _read_pcm_header(f):
+    header = f.read(PCM_HEADER_SIZE)
+    if not header.startswith(PCM_MAGIC):
+        raise ValueError("not a pcm cache file")
+    sample_rate, channels, dtype = struct.unpack_from("<IH8s", header, len(PCM_MAGIC))
+    return sample_rate, channels, dtype.rstrip(b"\0").decode()
+
+
+def decode_to_raw(filepath, raw_filepath):
+    """
+    音声を一度だけデコードし，ヘッダ(サンプルレート，チャンネル数，型)に続けて
+    int16のPCMをそのままファイルに書き出す
+    """
+    sample_rate, channels = probe_audio(filepath)
+    proc = subprocess.Popen([
+        "ffmpeg", "-v", "error", "-i", filepath,
+        "-map", "a:0", "-f", "s16le", "-acodec", "pcm_s16le", "-",
+    ], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    with open(raw_filepath, "wb") as f:
+        f.write(_pcm_header(sample_rate, channels))
+        shutil.copyfileobj(proc.stdout, f, 1024 * 1024)
+    proc.stdout.close()
+    if proc.wait() != 0:
+        raise RuntimeError(f"failed to decode {filepath}")
+    return sample_rate, channels
+
+
+def open_raw(raw_filepath):
+    """decode_to_rawで書き出したファイルをnumpy.memmapで開く"""
+    with open(raw_filepath, "rb") as f:
+        sample_rate, channels, dtype = _read_pcm_header(f)
+    pcm = np.memmap(raw_filepath, dtype=dtype, mode="r", offset=PCM_HEADER_SIZE)
+    return pcm.reshape(-1, channels), sample_rate, channels
+
+
+def open_pcm(filepath, cache=None):
+    """
+    デコード済みのPCMを (memmap, サンプルレート, チャンネル数) で返す
+    cacheがあればソースのパス，サイズ，mtimeをキーに再利用するので，
+    同じ音声を扱うコマンドはデコードせずにゼロコピーで区間を切り出せる
+    """
+    if cache is None:
+        fd, raw_filepath = tempfile.mkstemp(suffix=".pcm")
+        os.close(fd)
+        try:
+            decode_to_raw(filepath, raw_filepath)
+            return open_raw(raw_filepath)
+        finally:
+            # memmapしたままでもファイル自体は消してよい
+            os.remove(raw_filepath)
+
+    st = os.stat(filepath)
+    key = make_key(os.path.realpath(filepath), st.st_size, st.st_mtime_ns)
+    raw_filepath = cache.get(key, ".pcm")
+    if raw_filepath is not None:
+        return open_raw(raw_filepath)
+
+    raw_filepath = cache.path(key, ".pcm")
+    os.makedirs(os.path.dirname(raw_filepath), exist_ok=True)
+    tmp_filepath = f"{raw_filepath}.{os.getpid()}.tmp"
+    try:
+        decode_to_raw(filepath, tmp_filepath)
+        os.replace(tmp_filepath, raw_filepath)
+    finally:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+    # 開いてから古いものを消す(開いたmemmapは消されても使える)
+    opened = open_raw(raw_filepath)
+    cache.prune()
+    return opened
+
+
+def iter_pcm_slices(pcm, sample_rate, block_sec=30.):
+    block = int(block_sec * sample_rate)
+    for i in range(0, len(pcm), block):
+        yield pcm[i:i + block]
+
+
+def encode_pcm(pcm, sample_rate, channels, output_filepath, codec_args=("-q:a", "0")):
+    """int16のPCMをffmpegの標準入力に渡してエンコードする"""
+    subprocess.run([
+        "ffmpeg", "-v", "error",
+        "-f", "s16le", "-ar", str(sample_rate), "-ac", str(channels), "-i", "-",
+        *codec_args, output_filepath, "-y",
+    ], input=np.ascontiguousarray(pcm).tobytes(),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+
+
+def cut_segments(audio_filepath, ranges, output_filepaths, max_workers=8, cache=None):
+    """
+    音声を一度だけデコードし，(開始[sec], 終了[sec]) の各区間を切り出してエンコードする
+    区間毎にffmpegで先頭からデコードし直さないので，区間数が多くても時間は増えにくい
+    成功した出力ファイルのインデックスのリストを返す
+    """
+    done = list()
+    pcm, sample_rate, channels = open_pcm(audio_filepath, cache)
+
+    def process(idx):
+        start, end = ranges[idx]
+        st = max(0, int(round(start * sample_rate)))
+        et = min(len(pcm), int(round(end * sample_rate)))
+        encode_pcm(pcm[st:et], sample_rate, channels, output_filepaths[idx])
+        return idx
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(process, idx) for idx in range(len(ranges))]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                done.append(future.result())
+            except Exception as e:
+                ic(e)
+    return sorted(done)
@@ -0,0 +1,58 @@
+import time
+import threading
+
+
+def is_throttle_error(e):
+    message = str(e).lower()
+    return any([
+        k in message
+        for k in ["429", "too many", "rate limit", "quota", "throttl"]])
+
+
+def is_transient_error(e):
+    """待ってやり直せば成功しうるエラー(スロットリングや通信の失敗)かどうか"""
+    if is_throttle_error(e) or isinstance(e, (ConnectionError, TimeoutError)):
+        return True
+    name = type(e).__name__.lower()
+    message = str(e).lower()
+    return any([
+        k in name or k in message
+        for k in ["timeout", "timed out", "connect", "temporar", "unavailable", "502", "503", "504"]])
+
+
+class AdaptiveRateLimiter():
+    """
+    トークンバケットによるレート制限
+    スロットリングされたらレートを半分にし，成功が続けば少しずつ上げる
+    """
+    def __init__(self, rate, min_rate, max_rate, burst=1., increase=0.05):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                        self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1.:
+                    self._tokens -= 1.
+                    return
+                wait = (1. - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2.)
+            self._tokens = 0.
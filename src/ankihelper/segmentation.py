@@ -0,0 +1,50 @@
+import spacy
+from icecream import ic
+
+
+# 文分割に使わないコンポーネント (文境界はparserが決める)
+_UNUSED_COMPONENTS = ["tagger", "attribute_ruler", "lemmatizer", "ner"]
+
+_nlp_by_key = dict()
+
+
+def load_sentence_pipeline(model_name="en_core_web_sm", fast=False):
+    """
+    文分割用のパイプラインを一度だけロードして使い回す
+    fast=Trueならモデルを使わずルールベースのsentencizerだけで分割する
+    モデルが入っていない時だけダウンロードする
+    """
+    key = "sentencizer" if fast else model_name
+    if key in _nlp_by_key:
+        return _nlp_by_key[key]
+
+    if fast:
+        nlp = spacy.blank("en")
+        nlp.add_pipe("sentencizer")
+    else:
+        if not spacy.util.is_package(model_name):
+            ic(f"download {model_name}")
+            spacy.cli.download(model_name)
+        nlp = spacy.load(model_name, exclude=_UNUSED_COMPONENTS)
+    _nlp_by_key[key] = nlp
+    return nlp
+
+
+def split_sentences(
+        texts,
+        model_name="en_core_web_sm",
+        fast=False,
+        batch_size=256,
+        n_process=1):
+    """
+    各テキストの文を (文, 開始文字位置, 終了文字位置) のリストとして順に返す
+    nlp.pipeでまとめて処理し，n_process > 1 なら複数プロセスで分割する
+    """
+    nlp = load_sentence_pipeline(model_name, fast)
+    texts = [str(t) for t in texts]
+    if len(texts) > 0:
+        nlp.max_length = max(nlp.max_length, max([len(t) for t in texts]) + 1)
+    for doc in nlp.pipe(texts, batch_size=batch_size, n_process=n_process):
+        yield [
+            (sent.text.strip(), sent.start_char, sent.end_char)
+            for sent in doc.sents]
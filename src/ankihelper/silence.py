@@ -0,0 +1,165 @@
+import numpy as np
+
+from .pcm import (
+        probe_audio,
+        iter_pcm_blocks,
+        iter_pcm_slices,
+        open_pcm,
+        )
+
+
+class NonsilentDetector():
+    """
+    pydub.silence.detect_nonsilent と同じ結果になるように
+    PCMのブロックを順に受け取りながら無音でない区間(ms)を求める
+
+    seek_step[ms]毎(と最後)に始まる min_silence_len[ms] の窓のRMS(整数に切り捨て)が
+    silence_thresh[dBFS]以下なら窓全体を無音とし，その和集合の補集合を無音でない区間とする．
+    保持するのは直近の1ブロックと窓1つ分の累積エネルギーだけなので，
+    入力の長さによらずメモリ使用量は一定
+    """
+    def __init__(
+            self,
+            sample_rate,
+            min_silence_len=1000,
+            silence_thresh=-16,
+            seek_step=1,
+            sample_width=2):
+        if not 1 <= seek_step <= min_silence_len:
+            # pydubは窓が離れていても連続した開始位置なら無音区間を繋げてしまう
+            raise ValueError(
+                    f"seek_step ({seek_step}) must be in [1, min_silence_len ({min_silence_len})]")
+        self.sample_rate = sample_rate
+        self.seek_step = seek_step
+        self.window = int(min_silence_len)
+        max_amplitude = float(2 ** (8 * sample_width - 1))
+        # audioop.rms は整数に切り捨てるので rms <= thresh は平均二乗 < (floor(thresh)+1)^2
+        self.thresh_power = (np.floor(10 ** (silence_thresh / 20.) * max_amplitude) + 1) ** 2
+
+        self._num_samples = 0   # これまでに受け取ったサンプル数(フレーム単位)
+        self._energy = 0        # これまでの二乗和
+        self._next_boundary = 0  # 次に境界値を求めるms
+        self._bounds = np.zeros(0, dtype=np.int64)   # 未評価の境界のサンプル位置
+        self._prefix = np.zeros(0, dtype=np.int64)   # 境界での累積二乗和
+        self._first = 0          # _bounds[0] のms
+        self._silent_until = 0   # 無音窓が覆う最後のms+1
+        self._prev_nonsilent = False
+        self._run_start = None
+        self._channels = 1
+
+    def _boundary(self, ms):
+        # pydubと同じく int(ms * sample_rate / 1000.)
+        return (ms * self.sample_rate) // 1000
+
+    def _emit(self, silent, offset):
+        """確定したmsの無音マスクから区間を作る"""
+        nonsilent = ~silent
+        d = np.diff(np.concatenate(
+            [[self._prev_nonsilent], nonsilent]).astype(np.int8))
+        starts = list(np.flatnonzero(d == 1) + offset)
+        ends = list(np.flatnonzero(d == -1) + offset)
+        self._prev_nonsilent = bool(nonsilent[-1])
+
+        ranges = list()
+        if self._run_start is not None and len(ends) > 0:
+            ranges.append((self._run_start, ends.pop(0)))
+            self._run_start = None
+        for st, et in zip(starts, ends):
+            ranges.append((st, et))
+        if len(starts) > len(ends):
+            self._run_start = starts[-1]
+        return [(int(st), int(et)) for st, et in ranges]
+
+    def feed(self, block):
+        """int16のPCMブロック (サンプル数, チャンネル数) を加え，確定した区間を返す"""
+        block = np.asarray(block)
+        if block.ndim == 1:
+            block = block[:, None]
+        self._channels = block.shape[1]
+        power = np.square(block.astype(np.int64)).sum(axis=1)
+        cumsum = np.concatenate([[0], np.cumsum(power)]) + self._energy
+        s0 = self._num_samples
+        self._num_samples += len(block)
+        self._energy = int(cumsum[-1])
+
+        # このブロックで確定する境界を求める
+        last = (self._num_samples * 1000) // self.sample_rate
+        ks = np.arange(self._next_boundary, last + 1, dtype=np.int64)
+        self._next_boundary = last + 1
+        bounds = self._boundary(ks)
+        self._bounds = np.concatenate([self._bounds, bounds])
+        self._prefix = np.concatenate([self._prefix, cumsum[bounds - s0]])
+        return self._evaluate(final=False)
+
+    def _evaluate(self, final):
+        W = self.window
+        seg_len = None
+        if final:
+            # pydubの長さは四捨五入したms．足りない分は無音で埋めて窓の長さは変えない
+            seg_len = int(round(self._num_samples * 1000. / self.sample_rate))
+            if self._first + len(self._bounds) - 1 < seg_len:
+                self._bounds = np.concatenate([self._bounds, [self._boundary(seg_len)]])
+                self._prefix = np.concatenate([self._prefix, [self._energy]])
+        # 最後の窓はseek_stepの倍数でなくても評価するので，終わるまで1つ残しておく
+        num_windows = len(self._bounds) - W - (0 if final else 1)
+        ranges = list()
+        if num_windows > 0:
+            starts = np.arange(num_windows) + self._first
+            energy = self._prefix[W:W + num_windows] - self._prefix[:num_windows]
+            samples = (self._bounds[W:W + num_windows] - self._bounds[:num_windows]) * self._channels
+            aligned = starts % self.seek_step == 0
+            if final:
+                aligned |= starts == seg_len - W
+            silent_window = aligned & (energy < self.thresh_power * samples)
+            ends = np.where(silent_window, starts + W, -1)
+            covered = np.maximum.accumulate(
+                    np.concatenate([[self._silent_until], ends]))[1:]
+            ranges = self._emit(covered > starts, self._first)
+            self._silent_until = int(covered[-1])
+            self._first += num_windows
+            self._bounds = self._bounds[num_windows:]
+            self._prefix = self._prefix[num_windows:]
+
+        if final:
+            # 残りのmsを始点とする窓はないので，既存の窓で覆われているかで決まる
+            num_frames = min(len(self._bounds) - 1, seg_len - self._first)
+            if num_frames > 0:
+                frames = np.arange(num_frames) + self._first
+                ranges += self._emit(frames < self._silent_until, self._first)
+            if self._run_start is not None:
+                ranges.append((int(self._run_start), seg_len))
+                self._run_start = None
+        return ranges
+
+    def finish(self):
+        return self._evaluate(final=True)
+
+
+def detect_nonsilent_stream(
+        filepath,
+        min_silence_len=1000,
+        silence_thresh=-16,
+        seek_step=1,
+        block_sec=30.,
+        cache=None):
+    """
+    ファイルをブロック毎にデコードしながら無音でない区間[ms]を順に返す
+    cacheがあればデコード済みのPCMをmemmapで読む
+    """
+    if cache is None:
+        sample_rate, channels = probe_audio(filepath)
+        blocks = iter_pcm_blocks(
+                filepath, block_sec=block_sec, sample_rate=sample_rate, channels=channels)
+    else:
+        pcm, sample_rate, channels = open_pcm(filepath, cache)
+        blocks = iter_pcm_slices(pcm, sample_rate, block_sec=block_sec)
+    detector = NonsilentDetector(
+            sample_rate,
+            min_silence_len=min_silence_len,
+            silence_thresh=silence_thresh,
+            seek_step=seek_step)
+    for block in blocks:
+        for r in detector.feed(block):
+            yield r
+    for r in detector.finish():
+        yield r
@@ -1,11 +1,9 @@
 import os
-import time
-import random
 import shutil
 import json
+import ast
 from glob import glob
 
-from tqdm import tqdm
 import click
 from icecream import ic
 import pandas as pd
@@ -16,14 +14,36 @@ from sklearn.cluster import KMeans
 from sklearn.metrics import silhouette_score
 from sentence_transformers import SentenceTransformer
 from scipy.cluster.hierarchy import linkage, fcluster
-from gtts import gTTS
-import spacy
 
 from .utils import (
         extract_english_from_vtt,
         create_translator,
         clip_by_script,
         ImageGenerator,
+        get_tts_types,
+        get_image_profiles,
+        )
+from .segmentation import (
+        split_sentences,
+        )
+from .tts import (
+        CachedTTS,
+        )
+from .diffusion import (
+        CachedImageGenerator,
+        )
+from .media import (
+        EXT_BY_IMAGE_FORMAT,
+        encode_images,
+        get_image_formats,
+        )
+from .translation import (
+        ConcurrentTranslator,
+        TranslationMemory,
+        is_valid_translation,
+        )
+from .checkpoint import (
+        RowJobRunner,
         )
 
 
@@ -154,33 +174,114 @@ def from_audio_vtt_pair(
         "--model-id",
         type=click.Choice(list(ImageGenerator.get_diffuser_model_name_by_id().keys())),
         default="0")
+@click.option("--batch-size", type=int, default=1)
+@click.option("--num-inference-steps", type=int, default=None)
+@click.option("--seed", type=int, default=0)
+@click.option("--negative-prompt", type=str, default="ext, letters, words, watermark, negative")
+@click.option("--profile", type=click.Choice(get_image_profiles()), default="default")
+@click.option("--compile", is_flag=True, default=False)
+@click.option("--restart", is_flag=True, default=False)
 def add_image(
         input_table_filepath,
         output_table_filepath,
         output_image_dirpath,
         image_size,
-        model_id):
-    gen = ImageGenerator(
-            ImageGenerator.get_diffuser_model_name_by_id()[model_id])
-
-    shutil.rmtree(output_image_dirpath, ignore_errors=True)
+        model_id,
+        batch_size,
+        num_inference_steps,
+        seed,
+        negative_prompt,
+        profile,
+        compile,
+        restart):
+    gen = CachedImageGenerator(model_id, profile=profile, compile=compile)
+
+    runner = RowJobRunner.for_output(
+            output_table_filepath, batch_size=batch_size, restart=restart)
+    if not runner.exists():
+        shutil.rmtree(output_image_dirpath, ignore_errors=True)
     os.makedirs(output_image_dirpath, exist_ok=True)
 
     df = pd.read_csv(input_table_filepath, header=0)
-    image_filepaths = list()
-    for i, row in tqdm(enumerate(df.itertuples()), total=len(df)):
-        images = gen.generate(row.en, height=image_size, width=image_size)
-        imgpaths = list()
-        for j, img in enumerate(images):
-            imgpath = os.path.join(output_image_dirpath, f"image_{i}_{j}.jpg")
-            imgpaths.append(imgpath)
-            img.save(imgpath, format="JPEG")
-        image_filepaths.append(imgpaths)
-
-    df["image"] = image_filepaths
+
+    def generate(batch):
+        # キャッシュにない行だけを一度に生成する
+        image_filepaths = [
+                os.path.join(output_image_dirpath, f"image_{i}_0.jpg")
+                for i, _ in batch]
+        gen.generate_to_files(
+                [text for _, text in batch],
+                image_filepaths,
+                height=image_size,
+                width=image_size,
+                negative_prompt=negative_prompt,
+                num_inference_steps=num_inference_steps,
+                seed=seed)
+        return [[imgpath] for imgpath in image_filepaths]
+
+    df["image"] = runner.run(
+            [[i, text] for i, text in enumerate(df["en"])],
+            generate)
+    gen.report()
 
     df.to_csv(output_table_filepath, index=False)
+    runner.finish()
+
+
+
+@table.command()
+@click.argument("input_table_filepath", type=str)
+@click.option("--output_table_filepath", type=str, default="/tmp/table-with-compact-image.csv")
+@click.option("--output_image_dirpath", type=str, default="/tmp/compact-images")
+@click.option("--column", type=str, default="image")
+@click.option("--format", "image_format", type=click.Choice(get_image_formats()), default="webp")
+@click.option("--max-size", type=int, default=None)
+@click.option("--quality", type=int, default=80)
+@click.option("--num-workers", type=int, default=os.cpu_count())
+def compact_images(
+        input_table_filepath,
+        output_table_filepath,
+        output_image_dirpath,
+        column,
+        image_format,
+        max_size,
+        quality,
+        num_workers):
+    """画像の列の画像を縮小・再エンコードし，パスを置き換えた表を保存する"""
+    df = pd.read_csv(input_table_filepath, header=0)
+    shutil.rmtree(output_image_dirpath, ignore_errors=True)
+    os.makedirs(output_image_dirpath, exist_ok=True)
 
+    # add-imageの出力は各行が画像のパスのリスト
+    rows = [
+            ast.literal_eval(v) if isinstance(v, str) and v.startswith("[") else [v]
+            for v in df[column]]
+    ext = EXT_BY_IMAGE_FORMAT[image_format]
+    src_filepaths = list()
+    dst_filepaths = list()
+    new_rows = list()
+    for i, filepaths in enumerate(rows):
+        new_filepaths = list()
+        for j, filepath in enumerate(filepaths):
+            if not isinstance(filepath, str):
+                continue
+            # 別のディレクトリの同じ名前の画像で上書きしないように行と列の番号で名付ける
+            dst = os.path.join(output_image_dirpath, f"image_{i}_{j}{ext}")
+            src_filepaths.append(filepath)
+            dst_filepaths.append(dst)
+            new_filepaths.append(dst)
+        new_rows.append(new_filepaths)
+
+    encode_images(
+            src_filepaths,
+            dst_filepaths,
+            max_size=max_size,
+            format=image_format,
+            quality=quality,
+            num_workers=num_workers)
+    df[column] = new_rows
+    df.to_csv(output_table_filepath, index=False)
+    ic(output_table_filepath)
 
 
 @table.command()
@@ -192,10 +293,28 @@ def add_image(
             ["google-trans", "gcloud"]),
         default="google-trans")
 @click.option("--src-lang", type=click.Choice(["en", "jp"]), default="en")
-def add_trans(input_table_filepath, output_table_filepath, client_type, src_lang):
+@click.option("--concurrency", type=int, default=None)
+@click.option("--max-rate", type=float, default=None)
+@click.option("--no-tm", is_flag=True, default=False)
+@click.option("--restart", is_flag=True, default=False)
+def add_trans(
+        input_table_filepath,
+        output_table_filepath,
+        client_type,
+        src_lang,
+        concurrency,
+        max_rate,
+        no_tm,
+        restart):
     df = pd.read_csv(input_table_filepath, header=0)
 
-    translator = create_translator(client_type)
+    translator = ConcurrentTranslator.create(
+            create_translator(client_type),
+            client_type,
+            concurrency=concurrency,
+            max_rate=max_rate,
+            memory=None if no_tm else TranslationMemory(),
+            backend=client_type)
 
     if src_lang == "en":
         src = "en"
@@ -204,51 +323,58 @@ def add_trans(input_table_filepath, output_table_filepath, client_type, src_lang
         src = "ja"
         dest = "en"
 
-    def translate_text(text, retries=3):
-        print(f"try to translate: {text}")
-        for attempt in range(retries):
-            if text == "":
-                return ""
-            try:
-                translation = translator.translate(text=text, src=src, dest=dest)
-                if client_type != "gcloud":
-                    time.sleep(random.uniform(1, 3))  # 1〜3秒のランダムな遅延
-                print(translation)
-                return translation
-            except Exception as e:
-                return ""
-               #print(f"{e}")
-               #time.sleep(5)  # 5秒待機してリトライ
-        return "Error"
-
-    df[dest] = df[src].apply(lambda x: translate_text(x))
+    # 全てのスレッドに塊が行き渡るだけの行をまとめてから翻訳する
+    runner = RowJobRunner.for_output(
+            output_table_filepath,
+            batch_size=translator.concurrency * translator.batch_items,
+            restart=restart)
+    df[dest] = runner.run(
+            [t if isinstance(t, str) else None for t in df[src]],
+            lambda batch: translator.translate_all(batch, src, dest),
+            is_done=is_valid_translation)
     df.to_csv(output_table_filepath, index=False)
+    runner.finish()
 
 
 @table.command()
 @click.argument("input_table_filepath", type=str)
 @click.option("--output_audio_dirpath", type=str, default="/tmp/audio")
 @click.option("--output_table_filepath", type=str, default="/tmp/table-with-audio.csv")
-def add_audio(input_table_filepath, output_audio_dirpath, output_table_filepath):
+@click.option("--tts", "tts_type", type=click.Choice(get_tts_types()), default="gtts")
+@click.option("--concurrency", type=int, default=None)
+@click.option("--batch-size", type=int, default=None)
+@click.option("--restart", is_flag=True, default=False)
+def add_audio(
+        input_table_filepath,
+        output_audio_dirpath,
+        output_table_filepath,
+        tts_type,
+        concurrency,
+        batch_size,
+        restart):
     df = pd.read_csv(input_table_filepath, quotechar='"')
     ic(df["en"])
     english_texts = df["en"]
 
-    shutil.rmtree(output_audio_dirpath, ignore_errors=True)
+    runner = RowJobRunner.for_output(output_table_filepath, batch_size=100, restart=restart)
+    if not runner.exists():
+        shutil.rmtree(output_audio_dirpath, ignore_errors=True)
     os.makedirs(output_audio_dirpath, exist_ok=True)
 
-    audio_paths = []
-    for i, text in tqdm(enumerate(english_texts), total=len(english_texts)):
-        audio_filename = f"audio_{i+1}.mp3"
-        audio_path = os.path.join(output_audio_dirpath, audio_filename)
-
-        tts = gTTS(text, lang='en')
-        tts.save(audio_path)
+    tts = CachedTTS(tts_type, concurrency=concurrency, batch_size=batch_size)
 
-        audio_paths.append(audio_path)
+    def synthesize(batch):
+        audio_paths = [
+                os.path.join(output_audio_dirpath, f"audio_{i+1}.mp3")
+                for i, _ in batch]
+        return tts.save_many([text for _, text in batch], 'en', audio_paths)
 
-    df['en_audio'] = audio_paths
+    df['en_audio'] = runner.run(
+            [[i, text] for i, text in enumerate(english_texts)],
+            synthesize)
+    tts.report()
     df.to_csv(output_table_filepath, index=False)
+    runner.finish()
 
 
 @table.command()
@@ -307,16 +433,20 @@ def add_categories(
 @table.command()
 @click.argument("input_filepath", type=str)
 @click.option("--output_table_filepath", type=str, default="/tmp/table-aligned.csv")
-def alignment(input_filepath, output_table_filepath):
-    spacy.cli.download("en_core_web_sm")
-    nlp = spacy.load("en_core_web_sm")
+@click.option("--fast", is_flag=True, default=False)
+@click.option("--batch-size", type=int, default=256)
+@click.option("--n-process", type=int, default=1)
+def alignment(input_filepath, output_table_filepath, fast, batch_size, n_process):
     df_in = pd.read_csv(input_filepath, names=["stamp", "en"])
     print(df_in)
 
     dict_out = []
-    for row in df_in.itertuples():
-        doc = nlp(row.en)
-        for sent in doc.sents:
+    for sents in split_sentences(
+            df_in["en"],
+            fast=fast,
+            batch_size=batch_size,
+            n_process=n_process):
+        for sent, _, _ in sents:
             dict_out.append({"en": sent})
     df_out = pd.DataFrame.from_dict(dict_out)
     df_out.to_csv(output_table_filepath)
@@ -1,7 +1,9 @@
 import os
+import time
 import shutil
 import json
-from collections import defaultdict
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import click
 from icecream import ic
@@ -9,16 +11,33 @@ import pdfplumber
 import pandas as pd
 from PIL import Image
 import pytesseract
-from gtts import gTTS
-import spacy
 import numpy as np
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
 from tqdm import tqdm
 
 
 from .utils import (
         format_timestamp,
         create_translator,
+        align_sentences_to_words,
+        get_tts_types,
+        )
+from .segmentation import (
+        split_sentences,
+        )
+from .cache import (
+        FileCache,
+        hash_file,
+        make_key,
+        )
+from .tts import (
+        CachedTTS,
+        benchmark_tts,
+        )
+from .translation import (
+        TranslationMemoryTranslator,
         )
 
 
@@ -33,47 +52,220 @@ def text():
 @click.option("--output-dirpath", type=str, default="/tmp")
 @click.option("--output-filename", type=str, default=None)
 @click.option("--lang", "-l", type=click.Choice(["en", "jp"]), default="en")
-def to_audio(input_text, output_dirpath, output_filename, lang):
+@click.option("--tts", "tts_type", type=click.Choice(get_tts_types()), default="gtts")
+def to_audio(input_text, output_dirpath, output_filename, lang, tts_type):
     ic(input_text)
 
-    tts = gTTS(input_text, lang=lang)
+    tts = CachedTTS(tts_type)
     if output_filename is None:
         output_filename = input_text.lower().replace(" ", "-").strip("'\`\"\'.[]()!?/\\")
     output_filepath = os.path.join(
             output_dirpath,
             f"{output_filename}.mp3")
-    tts.save(output_filepath)
+    tts.save(input_text, lang, output_filepath)
+    tts.report()
     ic(output_filepath)
 
 
 @text.command()
-@click.argument("input_filepath", type=str)
-@click.option("-o", "--output_dirpath", type=str, default="/tmp")
-def from_pdf(input_filepath, output_dirpath):
-    filename = ic(os.path.basename(input_filepath))
-    ic(output_dirpath)
-    os.makedirs(output_dirpath, exist_ok=True)
+@click.option("--tts", "tts_types", type=click.Choice(get_tts_types()), multiple=True)
+@click.option("--num-clips", type=int, default=50)
+@click.option("--batch-size", type=int, default=None)
+def benchmark_audio(tts_types, num_clips, batch_size):
+    """各TTSバックエンドの合成速度(clips/sec)を比べる"""
+    if len(tts_types) == 0:
+        tts_types = get_tts_types()
+    texts = [
+            f"This is sentence number {i} for the speech synthesis benchmark."
+            for i in range(num_clips)]
+    for tts_type in tts_types:
+        rate = benchmark_tts(tts_type, texts, batch_size=batch_size)
+        print(f"{tts_type}: {rate:.2f} clips/sec")
+
+
+def parse_page_ranges(pages, num_pages):
+    """"1-3,7" のような1始まりのページ指定を0始まりのインデックスのリストにする"""
+    if pages is None:
+        return list(range(num_pages))
+    indices = list()
+    for part in pages.split(","):
+        if "-" in part:
+            st, et = part.split("-")
+            st = int(st) if st else 1
+            et = int(et) if et else num_pages
+            indices += list(range(st - 1, min(et, num_pages)))
+        else:
+            indices.append(int(part) - 1)
+    return sorted(set([i for i in indices if 0 <= i < num_pages]))
+
+
+def _extract_pages(input_filepath, indices, output_dirpath):
+    """ワーカー毎にPDFを開き，ページ毎にテキストを書き出してレイアウト情報を捨てる"""
+    filename = os.path.basename(input_filepath)
+    texts = list()
     with pdfplumber.open(input_filepath) as pdf:
-        for i, page in enumerate(pdf.pages):
+        for i in indices:
+            page = pdf.pages[i]
+            text = page.extract_text() or ""
+            page.close()
             with open(
                     os.path.join(
                         output_dirpath,
                         f"{filename}_{i:02d}.txt"),
                     "w") as f:
-                f.write(page.extract_text())
+                f.write(text)
+            texts.append((i, text))
+    return texts
+
+
+@text.command()
+@click.argument("input_filepath", type=str)
+@click.option("-o", "--output_dirpath", type=str, default="/tmp")
+@click.option("--pages", type=str, default=None, help='e.g. "1-10,15"')
+@click.option("--num-workers", type=int, default=os.cpu_count())
+@click.option("--pages-per-task", type=int, default=8)
+@click.option("--jsonl", "jsonl_filepath", type=str, default=None)
+def from_pdf(
+        input_filepath,
+        output_dirpath,
+        pages,
+        num_workers,
+        pages_per_task,
+        jsonl_filepath):
+    filename = ic(os.path.basename(input_filepath))
+    ic(output_dirpath)
+    os.makedirs(output_dirpath, exist_ok=True)
+    with pdfplumber.open(input_filepath) as pdf:
+        num_pages = len(pdf.pages)
+    indices = parse_page_ranges(pages, num_pages)
+    chunks = [
+            indices[i:i + pages_per_task]
+            for i in range(0, len(indices), pages_per_task)]
+
+    begin = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max(1, num_workers)) as executor, \
+            (open(jsonl_filepath, "w") if jsonl_filepath is not None else nullcontext()) as jsonl_file:
+        futures = {
+                executor.submit(_extract_pages, input_filepath, chunk, output_dirpath): j
+                for j, chunk in enumerate(chunks)}
+        # JSON Linesはページ順に，揃ったチャンクから追記する
+        results = dict()
+        next_j = 0
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            texts = future.result()
+            if jsonl_file is None:
+                continue
+            results[futures[future]] = texts
+            while next_j in results:
+                for i, text in results.pop(next_j):
+                    jsonl_file.write(json.dumps(
+                        {"file": filename, "page": i + 1, "text": text},
+                        ensure_ascii=False) + "\n")
+                next_j += 1
+            jsonl_file.flush()
+    elapsed = time.perf_counter() - begin
+    if jsonl_filepath is not None:
+        ic(jsonl_filepath)
+    print(f"{len(indices)} pages in {elapsed:.1f} sec ({len(indices) / elapsed:.2f} pages/sec)")
+
+
+def otsu_threshold(gray):
+    """グレースケール画像(uint8)の大津の二値化の閾値"""
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    w0 = np.cumsum(hist)
+    w1 = w0[-1] - w0
+    m0 = np.cumsum(hist * levels)
+    m1 = m0[-1] - m0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = w0 * w1 * (m0 / w0 - m1 / w1) ** 2
+    return int(np.nanargmax(between))
+
+
+def preprocess_image(image, grayscale=False, binarize=False, max_size=None):
+    """tesseractに渡す前に縮小，グレースケール化，二値化して処理を軽くする"""
+    if max_size is not None and max(image.size) > max_size:
+        image.thumbnail((max_size, max_size))
+    if grayscale or binarize:
+        gray = np.asarray(image.convert("L"))
+        if binarize:
+            gray = np.where(gray > otsu_threshold(gray), 255, 0).astype(np.uint8)
+        image = Image.fromarray(gray)
+    return image
+
+
+def _ocr_image(filepath, lang, grayscale, binarize, max_size):
+    with Image.open(filepath) as image:
+        image = preprocess_image(image, grayscale, binarize, max_size)
+        return pytesseract.image_to_string(image, lang=lang)
 
 
 @text.command()
 @click.argument("input_filepaths", type=str, nargs=-1)
 @click.option("-l", "--lang", type=click.Choice(["eng", "jpn"]), default="eng")
-def from_image(input_filepaths, lang):
+@click.option("-o", "--output_dirpath", type=str, default="/tmp/text-from-image")
+@click.option("--num-workers", type=int, default=os.cpu_count())
+@click.option("--grayscale", is_flag=True, default=False)
+@click.option("--binarize", is_flag=True, default=False)
+@click.option("--max-size", type=int, default=None)
+@click.option("--no-cache", is_flag=True, default=False)
+def from_image(
+        input_filepaths,
+        lang,
+        output_dirpath,
+        num_workers,
+        grayscale,
+        binarize,
+        max_size,
+        no_cache):
     ic(input_filepaths)
-    images = [Image.open(f) for f in input_filepaths]
+    os.makedirs(output_dirpath, exist_ok=True)
+    cache = None if no_cache else FileCache("ocr")
+    options = (lang, grayscale, binarize, max_size)
+
+    # 結合したテキストは入力順に，揃ったものから追記する
+    merged_file = open(f"/tmp/text-from-image-{lang}.txt", "w")
+    texts = dict()
+    next_idx = 0
+
+    def on_done(idx, text):
+        nonlocal next_idx
+        filepath = input_filepaths[idx]
+        # 別のディレクトリの同じ名前の画像で上書きしないように入力の番号を付ける
+        output_filename = f"{idx:04d}-{os.path.basename(filepath)}.txt"
+        with open(os.path.join(output_dirpath, output_filename), "w") as f:
+            f.write(text)
+        texts[idx] = text
+        while next_idx in texts:
+            merged_file.write(texts.pop(next_idx))
+            next_idx += 1
+        merged_file.flush()
+
     ic("extract text...")
-    texts = [pytesseract.image_to_string(image, lang=lang) for image in images]
-    ic(texts)
-    with open(f"/tmp/text-from-image-{lang}.txt", "w") as f:
-        [f.write(text) for text in texts]
+    keys = dict()
+    with ProcessPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        futures = dict()
+        for idx, filepath in enumerate(input_filepaths):
+            if cache is not None:
+                keys[idx] = make_key(hash_file(filepath), *options)
+                cached = cache.get(keys[idx], ".txt")
+                if cached is not None:
+                    with open(cached, "r") as f:
+                        on_done(idx, f.read())
+                    continue
+            futures[executor.submit(_ocr_image, filepath, *options)] = idx
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            idx = futures[future]
+            text = future.result()
+            if cache is not None:
+                cache.put_bytes(keys[idx], text.encode("utf-8"), ".txt")
+            on_done(idx, text)
+    merged_file.close()
+
+    if cache is not None:
+        cache.report()
+        cache.prune()
+    ic(output_dirpath)
 
 
 @text.command()
@@ -86,7 +278,9 @@ def from_image(input_filepaths, lang):
 @click.option("--src", type=click.Choice(["en", "ja"]), default="en")
 @click.option("--dest", type=click.Choice(["en", "ja"]), default="ja")
 def translate(input_text, client_type, src, dest):
-    translator = create_translator(client_type)
+    translator = TranslationMemoryTranslator(
+            create_translator(client_type),
+            client_type)
 
     translated_text = translator.translate(
             text=input_text,
@@ -136,7 +330,8 @@ def whisper_result_to_vtt(input_filepath):
 
 @text.command()
 @click.argument("input_filepath", type=str)
-def fix_whisper_result(input_filepath):
+@click.option("--fast", is_flag=True, default=False)
+def fix_whisper_result(input_filepath, fast):
     ic(input_filepath)
     ic.disable()
     with open(input_filepath, "r") as f:
@@ -144,34 +339,35 @@ def fix_whisper_result(input_filepath):
 
     all_text = ic(" ".join([seg["text"].strip() for seg in result["segments"]]))
 
-    nlp = spacy.load("en_core_web_sm")
-    doc = nlp(all_text)
-    sentences = ic([sent.text.strip() for sent in doc.sents])
+    sents = next(split_sentences([all_text], fast=fast))
+    sentences = ic([sent for sent, _, _ in sents])
+    spans = [(st, et) for _, st, et in sents]
 
     for s in sentences:
         print("---")
         print(s)
 
-    new_segments = []
-    current_pos = 0
     words = [w for s in result["segments"] for w in s.get("words", [])]
 
-    for sentence in sentences:
-        sentence_words = sentence.split()
-        n = len(sentence_words)
-
-        # 該当する単語を元のwordリストから探す
-        for i in range(current_pos, len(words) - n + 1):
-            if [w["word"].strip() for w in words[i:i+n]] == sentence_words:
-                start_time = words[i]["start"]
-                end_time = words[i+n-1]["end"]
-                new_segments.append({
-                    "start": start_time,
-                    "end": end_time,
-                    "text": sentence
-                })
-                current_pos = i + n
-                break
+    # 文の文字位置を単語のインデックスに一度の走査で対応付ける
+    new_segments = []
+    unaligned = []
+    for sentence, aligned in zip(
+            sentences, align_sentences_to_words(all_text, spans, words)):
+        if aligned is None:
+            unaligned.append(sentence)
+            continue
+        i, j = aligned
+        new_segments.append({
+            "start": words[i]["start"],
+            "end": words[j]["end"],
+            "text": sentence
+        })
+
+    ic.enable()
+    ic(len(new_segments), len(unaligned))
+    for sentence in unaligned:
+        print(f"not aligned: {sentence}")
 
     with open("/tmp/new-script.vtt", "w") as f:
         f.write("WEBVTT\n\n")
@@ -181,45 +377,87 @@ def fix_whisper_result(input_filepath):
             f.write(f"{seg['text']}\n\n")
 
 
-@text.command()
-@click.argument("input_filepath", type=str)
-@click.option("--output_filepath", type=str, default="/tmp/script-inspected.csv")
-def inspect_whisper_result(input_filepath, output_filepath):
-    ic(input_filepath)
-
+def _load_word_columns(input_filepath):
+    """書き起こし結果の単語を (単語, 長さ[sec]) の列に平坦化する"""
     with open(input_filepath, "r") as f:
         result = json.load(f)
+    words = [word for seg in result["segments"] for word in seg.get("words", [])]
+    return (
+        input_filepath,
+        np.array([word["word"] for word in words], dtype=object),
+        np.array([word["end"] - word["start"] for word in words], dtype=np.float64))
 
-    spec_by = defaultdict(list)
-    for seg in result["segments"]:
-        for word in seg["words"]:
-            w = word["word"].strip(" -.,!?\"").lower()
-            dt = word["end"] - word["start"]
-            spec_by[w].append(dt)
-
-    ic(spec_by)
-    out = list()
-    for word, dts in spec_by.items():
-        out.append({
-            "word": word,
-            "num": len(dts),
-            "dt_mean": np.mean(dts),
-            "dt_std": np.std(dts),
-            "dt_med": np.median(dts),
-            "dt_max": np.max(dts),
-            "dt_min": np.min(dts),
-            })
-
-    df = pd.DataFrame.from_dict(out)
-    df.to_csv(output_filepath, index=False)
+
+@text.command()
+@click.argument("input_filepaths", type=str, nargs=-1)
+@click.option("--output_filepath", type=str, default="/tmp/script-inspected.csv")
+@click.option("--num-workers", type=int, default=os.cpu_count())
+def inspect_whisper_result(input_filepaths, output_filepath, num_workers):
+    ic(len(input_filepaths))
+    if len(input_filepaths) == 0:
+        return
+
+    # JSONの読み込みと平坦化はファイル毎に並列に行う
+    with ProcessPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        columns = list(executor.map(_load_word_columns, input_filepaths))
+
+    df = pd.DataFrame({
+        "word": np.concatenate([words for _, words, _ in columns]),
+        "dt": np.concatenate([dts for _, _, dts in columns]),
+        "source": np.concatenate([
+            np.full(len(dts), i) for i, (_, _, dts) in enumerate(columns)]),
+        })
+    df["word"] = df["word"].str.strip(" -.,!?\"").str.lower()
+
+    # 単語毎の統計を一度のgroupbyでまとめて求める
+    g = df.groupby("word", sort=False)
+    out = pd.DataFrame({
+        "num": g["dt"].size(),
+        "dt_mean": g["dt"].mean(),
+        "dt_std": g["dt"].std(ddof=0),
+        "dt_med": g["dt"].median(),
+        "dt_max": g["dt"].max(),
+        "dt_min": g["dt"].min(),
+        "num_sources": g["source"].nunique(),
+        }).reset_index()
+
+    out.to_csv(output_filepath, index=False)
     ic(output_filepath)
 
 
+def _create_word_frequency_figure(df):
+    # pyplotを使わずAggのキャンバスに直接描く (GUIのバックエンドに依存しない)
+    fig = Figure(figsize=(10, 6))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.barh(
+            df["word"],
+            df["num"])
+    ax.set_title(f"Word frequency")
+    ax.set_xlabel("Word")
+    ax.set_ylabel("Frequency[-]")
+    return fig
+
+
+def _save_word_frequency_pngs(task, output_dir):
+    for i, df in task:
+        _create_word_frequency_figure(df).savefig(f"{output_dir}/freq-{i:04d}.png")
+
+
 @text.command()
 @click.argument("input_filepath", type=str)
 @click.option("--num-per-group", type=int, default=20)
 @click.option("--output_dir", type=str, default="/tmp")
-def show_word_frequency(input_filepath, num_per_group, output_dir):
+@click.option("--num-workers", type=int, default=os.cpu_count())
+@click.option("--groups-per-task", type=int, default=16)
+@click.option("--pdf", "pdf_filepath", type=str, default=None)
+def show_word_frequency(
+        input_filepath,
+        num_per_group,
+        output_dir,
+        num_workers,
+        groups_per_task,
+        pdf_filepath):
     ic(input_filepath)
     df = pd.read_csv(input_filepath, header=0)
     df = df.sort_values("num", ascending=True).reset_index(drop=True)
@@ -246,14 +484,25 @@ def show_word_frequency(input_filepath, num_per_group, output_dir):
             df.iloc[i:j]
             for i, j in zip(ns, ns[1:])]
 
-    for i in tqdm(range(len(dfs))):
-        df = dfs[i]
-        plt.figure(figsize=(10, 6))
-        plt.barh(
-                df["word"],
-                df["num"])
-        plt.title(f"Word frequency")
-        plt.xlabel("Word")
-        plt.ylabel("Frequency[-]")
-        plt.savefig(f"{output_dir}/freq-{i:04d}.png")
-        plt.close()
+    begin = time.perf_counter()
+    if pdf_filepath is not None:
+        # PDFは一つのストリームなので，このプロセスで順にページを追加する
+        with PdfPages(pdf_filepath) as pdf:
+            for df in tqdm(dfs):
+                pdf.savefig(_create_word_frequency_figure(df))
+        ic(pdf_filepath)
+        num_workers = 1
+    else:
+        tasks = [
+                [(i, dfs[i]) for i in range(j, min(j + groups_per_task, len(dfs)))]
+                for j in range(0, len(dfs), groups_per_task)]
+        with ProcessPoolExecutor(max_workers=max(1, num_workers)) as executor:
+            futures = [
+                    executor.submit(_save_word_frequency_pngs, task, output_dir)
+                    for task in tasks]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                future.result()
+    elapsed = time.perf_counter() - begin
+    print(
+        f"{len(dfs)} figures in {elapsed:.1f} sec "
+        f"({len(dfs) / elapsed:.1f} figures/sec, workers: {num_workers})")
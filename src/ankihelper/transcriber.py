@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from icecream import ic
+from tqdm import tqdm
+import numpy as np
+import torch
+import whisper
+
+from .utils import (
+        save_whisper_result_as_vtt,
+        group_words_into_sentences,
+        write_vtt_cues,
+        )
+from .pcm import (
+        iter_pcm_blocks,
+        )
+from .cache import (
+        hash_file,
+        make_key,
+        )
+
+
+# 各ワーカープロセスで一度だけロードされるモデル
+_model = None
+
+
+def load_whisper_model(model_name="small"):
+    device = "mps" if torch.backends.mps.is_available() else "cpu"
+    try:
+        model = whisper.load_model(model_name).to(device)
+        ic(f"Use {device}")
+    except NotImplementedError as e:
+        ic(e)
+        model = whisper.load_model(model_name, device="cpu")
+        ic("Use CPU")
+    return model
+
+
+def _init_worker(model_name, num_threads):
+    global _model
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    _model = load_whisper_model(model_name)
+
+
+def _transcribe(idx, filepath, word_timestamps, fp16):
+    result = _model.transcribe(
+            filepath,
+            word_timestamps=word_timestamps,
+            fp16=fp16)
+    return idx, result
+
+
+def get_vtt_filepath(filepath, output_dir):
+    return os.path.join(output_dir, f'{os.path.basename(filepath)}.vtt')
+
+
+def get_json_filepath(filepath, output_dir):
+    return os.path.join(output_dir, f'{os.path.basename(filepath)}.json')
+
+
+class WhisperTranscriber():
+    """
+    Whisperのモデルをワーカー毎に一度だけロードし、
+    複数の音声ファイルをプロセスプールで書き起こす
+    """
+    def __init__(
+            self,
+            model_name="small",
+            num_workers=1,
+            word_timestamps=True,
+            fp16=False,
+            cache=None):
+        self.model_name = model_name
+        self.num_workers = max(1, num_workers)
+        self.word_timestamps = word_timestamps
+        self.fp16 = fp16
+        self.cache = cache
+
+    def _cache_key(self, filepath):
+        return make_key(
+                hash_file(filepath),
+                self.model_name,
+                self.word_timestamps,
+                self.fp16)
+
+    def _on_done(self, filepath, result, output_dir):
+        save_whisper_result_as_vtt(result, get_vtt_filepath(filepath, output_dir))
+        with open(get_json_filepath(filepath, output_dir), "w") as f:
+            json.dump(result, f, indent=2)
+
+    def transcribe(self, filepaths, output_dir):
+        """
+        終わったものから結果をVTTとJSONに書き出し，結果は手元に残さない
+        JSONのパスを入力と同じ順番で返す
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        json_filepaths = [get_json_filepath(f, output_dir) for f in filepaths]
+        if len(filepaths) == 0:
+            return json_filepaths
+
+        begin = time.perf_counter()
+        keys = [None] * len(filepaths)
+        todo = list()
+        for idx, filepath in enumerate(filepaths):
+            if self.cache is not None:
+                keys[idx] = self._cache_key(filepath)
+                result = self.cache.get_json(keys[idx])
+                if result is not None:
+                    self._on_done(filepath, result, output_dir)
+                    continue
+            todo.append(idx)
+
+        def on_transcribed(idx, result):
+            self._on_done(filepaths[idx], result, output_dir)
+            if self.cache is not None:
+                self.cache.put_json(keys[idx], result)
+
+        # 全てキャッシュにあればモデルをロードしない
+        if len(todo) == 0:
+            pass
+        elif self.num_workers == 1 or len(todo) == 1:
+            _init_worker(self.model_name, 0)
+            for idx in tqdm(todo):
+                on_transcribed(
+                    *_transcribe(idx, filepaths[idx], self.word_timestamps, self.fp16))
+        else:
+            num_workers = min(self.num_workers, len(todo))
+            num_threads = max(1, os.cpu_count() // num_workers)
+            with ProcessPoolExecutor(
+                    max_workers=num_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.model_name, num_threads)) as executor:
+                futures = [
+                        executor.submit(
+                            _transcribe, idx, filepaths[idx], self.word_timestamps, self.fp16)
+                        for idx in todo]
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    on_transcribed(*future.result())
+        elapsed = time.perf_counter() - begin
+
+        if self.cache is not None:
+            self.cache.report()
+            self.cache.prune()
+
+        print(
+            f"{len(filepaths)} files in {elapsed:.1f} sec "
+            f"({len(filepaths) / elapsed:.2f} files/sec, workers: {self.num_workers})")
+        return json_filepaths
+
+
+def iter_audio_windows(filepath, window_sec, overlap_sec):
+    """
+    16kHzモノラルのfloat32音声を，overlap_secずつ重なる window_sec の窓で順に返す
+    (窓の開始時刻[sec], 音声, 最後の窓かどうか) を返す
+    """
+    sr = whisper.audio.SAMPLE_RATE
+    window = int(window_sec * sr)
+    step = window - int(overlap_sec * sr)
+    if overlap_sec < 0 or step <= 0:
+        raise ValueError(
+                f"overlap_sec ({overlap_sec}) must be in [0, window_sec ({window_sec}))")
+    buf = np.zeros(0, dtype=np.float32)
+    offset = 0
+    for block in iter_pcm_blocks(
+            filepath, sample_rate=sr, channels=1, resample=True):
+        buf = np.concatenate([buf, block[:, 0].astype(np.float32) / 32768.])
+        while len(buf) > window:
+            yield offset / sr, buf[:window], False
+            buf = buf[step:]
+            offset += step
+    yield offset / sr, buf, True
+
+
+def transcribe_stream(
+        model,
+        filepath,
+        vtt_filepath,
+        jsonl_filepath,
+        window_sec=600.,
+        overlap_sec=10.,
+        word_timestamps=True,
+        fp16=False):
+    """
+    長い音声を重なりのある窓毎に書き起こし，文が確定する度にVTTとJSON Linesへ追記する
+    窓の境界では重なりの中央を切れ目とし，単語の開始時刻でどちらの窓のものかを決める
+    """
+    cut = 0.
+    pending = list()
+    prompt = None
+    num_cues = 0
+    with open(vtt_filepath, "w", encoding="utf-8") as vtt_file, \
+            open(jsonl_filepath, "w", encoding="utf-8") as jsonl_file:
+        vtt_file.write("WEBVTT\n\n")
+        for t0, audio, last in tqdm(iter_audio_windows(filepath, window_sec, overlap_sec)):
+            if len(audio) == 0:
+                break
+            result = model.transcribe(
+                    audio,
+                    word_timestamps=word_timestamps,
+                    fp16=fp16,
+                    initial_prompt=prompt)
+            next_cut = float("inf") if last else t0 + window_sec - overlap_sec / 2.
+            for seg in result["segments"]:
+                for word in seg.get("words", []):
+                    word = dict(word, start=word["start"] + t0, end=word["end"] + t0)
+                    if cut <= word["start"] < next_cut:
+                        pending.append(word)
+            cut = next_cut
+
+            sentences, pending = group_words_into_sentences(pending)
+            if last and len(pending) > 0:
+                sentences.append((pending[0]["start"], pending[-1]["end"], pending))
+                pending = list()
+
+            write_vtt_cues(vtt_file, sentences)
+            for st, et, words in sentences:
+                jsonl_file.write(json.dumps({
+                    "start": st,
+                    "end": et,
+                    "text": "".join([w["word"] for w in words]),
+                    "words": words,
+                    }, ensure_ascii=False) + "\n")
+            vtt_file.flush()
+            jsonl_file.flush()
+            num_cues += len(sentences)
+            prompt = result["text"][-200:]
+    return num_cues
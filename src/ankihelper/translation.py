@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from icecream import ic
+from tqdm import tqdm
+
+from .utils import (
+        ITranslator,
+        )
+from .packing import (
+        pack_texts,
+        )
+from .cache import (
+        CACHE_ROOT,
+        normalize_text,
+        )
+from .ratelimit import (
+        AdaptiveRateLimiter,
+        is_throttle_error,
+        is_transient_error,
+        )
+
+
+# バックエンド毎の同時リクエスト数と秒間リクエスト数(初期値, 最小, 最大)
+LIMITS_BY_CLIENT_TYPE = {
+        "google-trans": {"concurrency": 4, "rate": 1., "min_rate": 0.2, "max_rate": 5.},
+        "gcloud": {"concurrency": 16, "rate": 20., "min_rate": 1., "max_rate": 100.},
+        }
+
+
+class ConcurrentTranslator():
+    """
+    ITranslatorを複数スレッドから同時に呼び出し，結果を入力と同じ順番で返す
+    失敗したらバックオフしてリトライし，最後まで失敗したものは"Error"とする
+    """
+    def __init__(
+            self,
+            translator,
+            concurrency=4,
+            rate=1.,
+            min_rate=0.2,
+            max_rate=5.,
+            retries=5,
+            backoff=2.,
+            memory=None,
+            backend=None,
+            batch_chars=4500,
+            batch_items=100):
+        self.translator = translator
+        self.batch_chars = batch_chars
+        self.batch_items = batch_items
+        self.memory = memory
+        self.backend = backend
+        self.concurrency = concurrency
+        self.limiter = AdaptiveRateLimiter(rate, min_rate, max_rate)
+        self.retries = retries
+        self.backoff = backoff
+
+    @classmethod
+    def create(cls, translator, client_type, **kwargs):
+        limits = dict(LIMITS_BY_CLIENT_TYPE.get(client_type, {}))
+        limits.update({k: v for k, v in kwargs.items() if v is not None})
+        # 上限を下げたら初期値と下限もそれを超えないようにする
+        if "max_rate" in limits:
+            for k in ["rate", "min_rate"]:
+                if k in limits:
+                    limits[k] = min(limits[k], limits["max_rate"])
+        return cls(translator, **limits)
+
+    def translate(self, text, src, dest):
+        if not isinstance(text, str) or text == "":
+            return ""
+        for attempt in range(self.retries):
+            self.limiter.acquire()
+            try:
+                translation = self.translator.translate(text=text, src=src, dest=dest)
+                self.limiter.on_success()
+                return translation
+            except Exception as e:
+                ic(e)
+                if is_throttle_error(e):
+                    self.limiter.on_throttle()
+                if not is_transient_error(e):
+                    break
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+        return "Error"
+
+    def translate_many(self, texts, src, dest):
+        """
+        まとめて一度に送る．通信の失敗などが最後まで続いたら全て"Error"とする
+        分け直せなかった文や，塊のどこかが原因で失敗した時は一文ずつ制限をかけて送り直す
+        """
+        translations = None
+        for attempt in range(self.retries):
+            self.limiter.acquire()
+            try:
+                translations = self.translator.translate_many(texts, src, dest)
+                self.limiter.on_success()
+                break
+            except Exception as e:
+                ic(e)
+                if is_throttle_error(e):
+                    self.limiter.on_throttle()
+                if not is_transient_error(e):
+                    translations = [None] * len(texts)
+                    break
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+        if translations is None:
+            return ["Error"] * len(texts)
+        return [
+            self.translate(text, src, dest) if translation is None else translation
+            for text, translation in zip(texts, translations)]
+
+    def translate_all(self, texts, src, dest):
+        """
+        翻訳メモリがあればまとめて引き，見つからなかった文だけを(重複なく)翻訳する
+        """
+        texts = list(texts)
+        begin = time.perf_counter()
+        found = dict()
+        if self.memory is not None:
+            found = self.memory.lookup_many(
+                    self.backend, src, dest, [t for t in texts if isinstance(t, str)])
+        misses = list(dict.fromkeys([
+            t for t in texts
+            if isinstance(t, str) and t.strip() != "" and normalize_text(t) not in found]))
+        ic(len(texts), len(misses))
+
+        # 複数の文を一つのリクエストにまとめる
+        batches = [
+                batch[i:i + self.batch_items]
+                for batch in pack_texts(misses, self.batch_chars)
+                for i in range(0, len(batch), self.batch_items)]
+        translated = list()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for translations in tqdm(
+                    executor.map(lambda b: self.translate_many(b, src, dest), batches),
+                    total=len(batches)):
+                translated += translations
+        if self.memory is not None:
+            self.memory.store_many(
+                    self.backend, src, dest,
+                    [
+                        (t, tr) for t, tr in zip(misses, translated)
+                        if is_valid_translation(tr)])
+        found.update({normalize_text(t): tr for t, tr in zip(misses, translated)})
+        elapsed = time.perf_counter() - begin
+        print(
+            f"{len(misses)} of {len(texts)} texts translated in {elapsed:.1f} sec "
+            f"(rate limit: {self.limiter.rate:.2f} req/sec)")
+        return [
+            found.get(normalize_text(t), "") if isinstance(t, str) else ""
+            for t in texts]
+
+
+TRANSLATION_MEMORY_FILEPATH = os.path.join(CACHE_ROOT, "translation-memory.sqlite3")
+
+
+class TranslationMemory():
+    """
+    (バックエンド, src, dest, 正規化したテキスト) をキーに訳文を保存するSQLiteのDB
+    """
+    def __init__(self, filepath=TRANSLATION_MEMORY_FILEPATH):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        self.filepath = filepath
+        self._conn = sqlite3.connect(filepath, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS tm ("
+                "backend TEXT, src TEXT, dest TEXT, text TEXT, translation TEXT, "
+                "PRIMARY KEY (backend, src, dest, text))")
+
+    def lookup_many(self, backend, src, dest, texts, chunk_size=500):
+        """見つかったものだけを {正規化したテキスト: 訳文} で返す"""
+        keys = list(set([normalize_text(t) for t in texts]))
+        found = dict()
+        with self._lock:
+            for i in range(0, len(keys), chunk_size):
+                chunk = keys[i:i + chunk_size]
+                rows = self._conn.execute(
+                    "SELECT text, translation FROM tm "
+                    "WHERE backend = ? AND src = ? AND dest = ? "
+                    f"AND text IN ({','.join(['?'] * len(chunk))})",
+                    [backend, src, dest, *chunk]).fetchall()
+                found.update(dict(rows))
+        return found
+
+    def store_many(self, backend, src, dest, pairs):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO tm VALUES (?, ?, ?, ?, ?)",
+                [
+                    (backend, src, dest, normalize_text(text), translation)
+                    for text, translation in pairs])
+
+    def lookup(self, backend, src, dest, text):
+        return self.lookup_many(backend, src, dest, [text]).get(normalize_text(text))
+
+    def store(self, backend, src, dest, text, translation):
+        self.store_many(backend, src, dest, [(text, translation)])
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM tm").fetchone()[0]
+
+    def export_jsonl(self, filepath):
+        with self._lock, open(filepath, "w") as f:
+            rows = self._conn.execute(
+                "SELECT backend, src, dest, text, translation FROM tm")
+            for backend, src, dest, text, translation in rows:
+                f.write(json.dumps({
+                    "backend": backend,
+                    "src": src,
+                    "dest": dest,
+                    "text": text,
+                    "translation": translation,
+                    }, ensure_ascii=False) + "\n")
+
+    def import_jsonl(self, filepath):
+        with open(filepath, "r") as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO tm VALUES (?, ?, ?, ?, ?)",
+                [
+                    (e["backend"], e["src"], e["dest"], normalize_text(e["text"]), e["translation"])
+                    for e in entries])
+        return len(entries)
+
+
+def is_valid_translation(translation):
+    return isinstance(translation, str) and translation not in ["", "Error"]
+
+
+class TranslationMemoryTranslator(ITranslator):
+    """任意のITranslatorを包み，翻訳メモリにないものだけを問い合わせる"""
+    def __init__(self, translator, backend, memory=None):
+        self._translator = translator
+        self.backend = backend
+        self.memory = TranslationMemory() if memory is None else memory
+
+    def translate(self, text, src, dest):
+        translation = self.memory.lookup(self.backend, src, dest, text)
+        if translation is None:
+            translation = self._translator.translate(text=text, src=src, dest=dest)
+            if is_valid_translation(translation):
+                self.memory.store(self.backend, src, dest, text, translation)
+        return translation
+
+
+@click.group()
+def tm():
+    pass
+
+
+@tm.command()
+def stats():
+    memory = TranslationMemory()
+    print(f"{memory.filepath}: {memory.count()} entries")
+
+
+@tm.command()
+@click.argument("output_filepath", type=str)
+def export(output_filepath):
+    TranslationMemory().export_jsonl(output_filepath)
+    ic(output_filepath)
+
+
+@tm.command(name="import")
+@click.argument("input_filepath", type=str)
+def import_(input_filepath):
+    num = TranslationMemory().import_jsonl(input_filepath)
+    print(f"imported {num} entries")
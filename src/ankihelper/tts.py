@@ -0,0 +1,142 @@
+import os
+import time
+import random
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from icecream import ic
+from tqdm import tqdm
+
+from .utils import (
+        create_tts,
+        )
+from .cache import (
+        FileCache,
+        make_key,
+        normalize_text,
+        link_or_copy,
+        )
+from .ratelimit import (
+        AdaptiveRateLimiter,
+        is_throttle_error,
+        is_transient_error,
+        )
+
+
+# バックエンド毎の同時リクエスト数と秒間リクエスト数(初期値, 最小, 最大)と
+# 一度に合成する文の数
+# localはプロセス内でまとめて推論するのでレート制限は実質かけない
+LIMITS_BY_BACKEND = {
+        "gtts": {
+            "concurrency": 4, "rate": 2., "min_rate": 0.5, "max_rate": 8.,
+            "batch_size": 1},
+        "local": {
+            "concurrency": 1, "rate": 1000., "min_rate": 1000., "max_rate": 1000.,
+            "batch_size": 16},
+        }
+
+
+class CachedTTS():
+    """
+    (バックエンド, 言語, 正規化したテキスト) をキーに合成した音声を保存しておき，
+    同じ文はもう一度合成せずに再利用する
+    """
+    def __init__(
+            self,
+            backend="gtts",
+            cache=None,
+            concurrency=None,
+            batch_size=None,
+            retries=5,
+            backoff=2.):
+        self.backend = backend
+        self.engine = create_tts(backend)
+        self.cache = FileCache("tts") if cache is None else cache
+        limits = LIMITS_BY_BACKEND[backend]
+        self.concurrency = limits["concurrency"] if concurrency is None else concurrency
+        self.batch_size = limits["batch_size"] if batch_size is None else batch_size
+        self.limiter = AdaptiveRateLimiter(
+                limits["rate"], limits["min_rate"], limits["max_rate"])
+        self.retries = retries
+        self.backoff = backoff
+
+    def _synthesize_with_retry(self, texts, lang, output_filepaths):
+        for attempt in range(self.retries):
+            self.limiter.acquire()
+            try:
+                self.engine.synthesize_many(texts, lang, output_filepaths)
+                self.limiter.on_success()
+                return
+            except Exception as e:
+                ic(e)
+                if is_throttle_error(e):
+                    self.limiter.on_throttle()
+                # 対応していない言語などはやり直しても失敗する
+                if not is_transient_error(e) or attempt == self.retries - 1:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    def _key(self, text, lang):
+        return make_key(self.backend, lang, normalize_text(text))
+
+    def _synthesize_to_cache(self, texts, lang):
+        """まとめて合成してキャッシュに入れる"""
+        with tempfile.TemporaryDirectory() as tmp_dirpath:
+            tmp_filepaths = [
+                    os.path.join(tmp_dirpath, f"{i}.mp3") for i in range(len(texts))]
+            self._synthesize_with_retry(texts, lang, tmp_filepaths)
+            for text, tmp_filepath in zip(texts, tmp_filepaths):
+                self.cache.put_file(self._key(text, lang), tmp_filepath, ".mp3")
+
+    def save(self, text, lang, output_filepath):
+        key = self._key(text, lang)
+        cached = self.cache.get(key, ".mp3")
+        if cached is None:
+            self._synthesize_to_cache([text], lang)
+            cached = self.cache.path(key, ".mp3")
+        link_or_copy(cached, output_filepath)
+        return output_filepath
+
+    def report(self):
+        self.cache.report()
+        self.cache.prune()
+
+    def save_many(self, texts, lang, output_filepaths):
+        """
+        複数の文を合成する．出力先は入力と同じ順番で対応する
+        キャッシュにない文だけを重複なくbatch_size毎にまとめ，concurrency個同時に合成する
+        """
+        begin = time.perf_counter()
+        misses = list(dict.fromkeys([
+            text for text in texts
+            if self.cache.get(self._key(text, lang), ".mp3") is None]))
+        batches = [
+                misses[i:i + self.batch_size]
+                for i in range(0, len(misses), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            list(tqdm(
+                executor.map(lambda b: self._synthesize_to_cache(b, lang), batches),
+                total=len(batches)))
+        for text, output_filepath in zip(texts, output_filepaths):
+            link_or_copy(self.cache.path(self._key(text, lang), ".mp3"), output_filepath)
+        elapsed = time.perf_counter() - begin
+        ic(f"{len(texts)} clips in {elapsed:.1f} sec ({len(texts) / elapsed:.2f} clips/sec)")
+        return list(output_filepaths)
+
+
+def benchmark_tts(backend, texts, lang="en", batch_size=None):
+    """キャッシュを使わずに合成し，clips/secを返す"""
+    engine = create_tts(backend)
+    if batch_size is None:
+        batch_size = LIMITS_BY_BACKEND[backend]["batch_size"]
+    # モデルのロードなどは計測に含めない
+    with tempfile.TemporaryDirectory() as tmp_dirpath:
+        engine.synthesize(texts[0], lang, os.path.join(tmp_dirpath, "warmup.mp3"))
+        begin = time.perf_counter()
+        for i in tqdm(range(0, len(texts), batch_size)):
+            batch = texts[i:i + batch_size]
+            engine.synthesize_many(
+                    batch, lang,
+                    [os.path.join(tmp_dirpath, f"{i + j}.mp3") for j in range(len(batch))])
+        elapsed = time.perf_counter() - begin
+    return len(texts) / elapsed
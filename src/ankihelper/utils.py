@@ -1,17 +1,30 @@
 from datetime import datetime, timedelta
 import os
 import re
+import bisect
+import threading
 import subprocess
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import numpy as np
 import pandas as pd
 from icecream import ic
-from tqdm import tqdm
 from googletrans import Translator
 from google.cloud import translate_v2 as GCloudTranslator
+from gtts import gTTS
 
 import torch
-from diffusers import StableDiffusionPipeline
+from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
+from transformers import VitsModel, AutoTokenizer
+
+from .packing import (
+        pack_texts,
+        split_translated_lines,
+        )
+from .pcm import (
+        get_pcm_cache,
+        cut_segments,
+        encode_pcm,
+        )
 
 
 def convert_vtt_time(vtt_time, offset=0):
@@ -21,6 +34,12 @@ def convert_vtt_time(vtt_time, offset=0):
     return dt.strftime("%H:%M:%S.%f")
 
 
+def vtt_time_to_sec(vtt_time, offset=0):
+    """VTTの時間フォーマット (hh:mm:ss.sss) を秒に変換し、offset(秒)を加える"""
+    h, m, sec = vtt_time.replace(',', '.').split(":")
+    return max(0., int(h) * 3600 + int(m) * 60 + float(sec) + offset)
+
+
 def parse_vtt(vtt_filepath):
     ic("reading vtt", vtt_filepath)
     with open(vtt_filepath, "r", encoding="utf-8") as f:
@@ -62,41 +81,107 @@ def format_timestamp(seconds):
     return f"{hours:02}:{minutes:02}:{secs:06.3f}".replace('.', ',')
 
 
-def save_whisper_result_as_vtt(result, output_filepath):
-    sentenses = list()
-    ranges = list()
+def group_words_into_sentences(words):
+    """
+    whisperの単語列を"."や"?"で終わる文にまとめる
+    (開始時刻, 終了時刻, 単語のリスト) のリストと，文として閉じていない残りの単語を返す
+    """
+    sentences = list()
     tmp = list()
     st = None
-    et = None
-    for seg in result["segments"]:
-        for word in seg["words"]:
-            if st is None:
-                st = word["start"]
-            tmp.append(word["word"])
-
-            if "Mr." in word["word"]:
-                continue
+    for word in words:
+        if st is None:
+            st = word["start"]
+        tmp.append(word)
 
-            if "." in word["word"] or "?" in word["word"]:
-                et = word["end"]
-                sentenses.append(tmp)
-                ranges.append((st, et))
+        if "Mr." in word["word"]:
+            continue
 
-                st = None
-                et = None
-                tmp = list()
+        if "." in word["word"] or "?" in word["word"]:
+            sentences.append((st, word["end"], tmp))
+            st = None
+            tmp = list()
 
-#   ic(len(sentenses))
-#   ic(len(ranges))
+    return sentences, tmp
 
-    with open(output_filepath, "w", encoding="utf-8") as vtt_file:
-        vtt_file.write("WEBVTT\n\n")  # VTTのヘッダー
 
-        for sentence, range_ in zip(sentenses, ranges):
-            vtt_file.write(f"{format_timestamp(range_[0])} --> {format_timestamp(range_[1])}\n")
-            vtt_file.write(f'{"".join(sentence)}\n\n')
+def write_vtt_cues(vtt_file, sentences):
+    for st, et, words in sentences:
+        vtt_file.write(f"{format_timestamp(st)} --> {format_timestamp(et)}\n")
+        vtt_file.write(f'{"".join([w["word"] for w in words])}\n\n')
+
+
+def save_whisper_result_as_vtt(result, output_filepath):
+    sentences, _ = group_words_into_sentences(
+            [word for seg in result["segments"] for word in seg["words"]])
 
-#   ic("done")
+    with open(output_filepath, "w", encoding="utf-8") as vtt_file:
+        vtt_file.write("WEBVTT\n\n")  # VTTのヘッダー
+        write_vtt_cues(vtt_file, sentences)
+
+
+def _normalized_chars(texts):
+    """英数字だけを小文字にして (文字, 何番目のテキストか, テキスト中の位置) に分解する"""
+    chars = list()
+    owners = list()
+    positions = list()
+    for i, text in enumerate(texts):
+        for j, c in enumerate(text):
+            if c.isalnum():
+                chars.append(c.lower())
+                owners.append(i)
+                positions.append(j)
+    return chars, owners, positions
+
+
+def _align_chars(a, b, lookahead=64, anchor=4):
+    """
+    二つの文字列を先頭から一度だけ走査して対応付ける
+    ずれたらlookaheadの範囲で次にanchor文字一致する位置を探して同期し直す
+    aの各文字に対応するbの位置(なければ-1)を返す
+    """
+    match = [-1] * len(a)
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i] == b[j]:
+            match[i] = j
+            i += 1
+            j += 1
+            continue
+        for d in range(1, lookahead):
+            if a[i + d:i + d + anchor] == b[j:j + anchor]:
+                i += d
+                break
+            if a[i:i + anchor] == b[j + d:j + d + anchor]:
+                j += d
+                break
+        else:
+            i += 1
+            j += 1
+    return match
+
+
+def align_sentences_to_words(text, spans, words):
+    """
+    textの文字範囲 (start_char, end_char) で表される各文を，whisperの単語のインデックス
+    (最初の単語, 最後の単語) に対応付ける．対応が取れない文はNoneとする
+    句読点や空白の違いは無視し，全体を一度だけ走査するので長い書き起こしでも線形時間
+    """
+    t_chars, _, t_pos = _normalized_chars([text])
+    w_chars, w_idx, _ = _normalized_chars([w["word"] for w in words])
+    match = _align_chars(t_chars, w_chars)
+
+    aligned = list()
+    for start_char, end_char in spans:
+        a = bisect.bisect_left(t_pos, start_char)
+        b = bisect.bisect_left(t_pos, end_char)
+        first = next((match[k] for k in range(a, b) if match[k] >= 0), None)
+        last = next((match[k] for k in range(b - 1, a - 1, -1) if match[k] >= 0), None)
+        if first is None or last is None:
+            aligned.append(None)
+        else:
+            aligned.append((w_idx[first], w_idx[last]))
+    return aligned
 
 
 class ITranslator():
@@ -107,14 +192,54 @@ class ITranslator():
             dest: str) -> str:
         raise NotImplementedError
 
+    def translate_many(
+            self,
+            texts: list,
+            src: str,
+            dest: str) -> list:
+        """まとめて翻訳できなかった文はNoneとし，呼び出し側で一文ずつ送り直す"""
+        return [self.translate(text, src, dest) for text in texts]
+
 
 class GoogleTranslator(ITranslator):
+    # 1リクエストの文字数の上限(5000)に余裕を持たせる
+    MAX_CHARS = 4500
+    # まとめた訳を分け直せないことがこの回数あったら，以降はまとめずに送る
+    MAX_MISMATCHES = 3
+
     def __init__(self):
         self._translator = Translator()
+        self._mismatches = 0
+        self._lock = threading.Lock()
 
     def translate(self, text, src, dest):
         return self._translator.translate(text, src=src, dest=dest).text
 
+    def translate_many(self, texts, src, dest):
+        """
+        複数の文を改行で区切って一度に送り，結果を文毎に分け直す
+        分け直せなかった塊の文はNoneとし，呼び出し側で一文ずつ送り直す
+        """
+        texts = [" ".join(text.split()) for text in texts]
+        if self._mismatches >= self.MAX_MISMATCHES:
+            return [None] * len(texts)
+        translations = list()
+        for pack in pack_texts(texts, self.MAX_CHARS):
+            if len(pack) == 1:
+                translations.append(self.translate(pack[0], src, dest))
+                continue
+            result = self._translator.translate("\n".join(pack), src=src, dest=dest)
+            lines = split_translated_lines(result, len(pack))
+            if lines is not None:
+                translations += lines
+                continue
+            translations += [None] * len(pack)
+            with self._lock:
+                self._mismatches += 1
+                if self._mismatches == self.MAX_MISMATCHES:
+                    ic("stop packing sentences into one request")
+        return translations
+
 
 class GoogleCloudTranslator(ITranslator):
     def __init__(self):
@@ -127,6 +252,14 @@ class GoogleCloudTranslator(ITranslator):
                 target_language=dest)
         return result["translatedText"]
 
+    def translate_many(self, texts, src, dest):
+        # APIがリストをそのまま受け付ける
+        results = self._translator.translate(
+                list(texts),
+                source_language=src,
+                target_language=dest)
+        return [result["translatedText"] for result in results]
+
 
 def create_translator(type_: str):
     translator_by = {
@@ -136,6 +269,79 @@ def create_translator(type_: str):
     return translator_by[type_]()
 
 
+class ITTS():
+    def synthesize(
+            self,
+            text: str,
+            lang: str,
+            output_filepath: str):
+        raise NotImplementedError
+
+    def synthesize_many(
+            self,
+            texts: list,
+            lang: str,
+            output_filepaths: list):
+        for text, output_filepath in zip(texts, output_filepaths):
+            self.synthesize(text, lang, output_filepath)
+
+
+class GoogleTTS(ITTS):
+    def synthesize(self, text, lang, output_filepath):
+        gTTS(text, lang=lang).save(output_filepath)
+
+
+class LocalTTS(ITTS):
+    """
+    MMSのVITSモデルでCPUだけで合成する．ネットワークに問い合わせない
+    複数の文をまとめて一度に推論する
+    """
+    model_name_by_lang = {
+            "en": "facebook/mms-tts-eng",
+            }
+
+    def __init__(self):
+        self._models = dict()
+
+    def _load(self, lang):
+        if lang not in self.model_name_by_lang:
+            raise ValueError(f"{lang} is not supported by local tts")
+        if lang not in self._models:
+            model_name = self.model_name_by_lang[lang]
+            self._models[lang] = (
+                    VitsModel.from_pretrained(model_name).eval(),
+                    AutoTokenizer.from_pretrained(model_name))
+        return self._models[lang]
+
+    def synthesize(self, text, lang, output_filepath):
+        self.synthesize_many([text], lang, [output_filepath])
+
+    def synthesize_many(self, texts, lang, output_filepaths):
+        model, tokenizer = self._load(lang)
+        inputs = tokenizer(list(texts), return_tensors="pt", padding=True)
+        with torch.inference_mode():
+            output = model(**inputs)
+        waveforms = output.waveform.cpu().numpy()
+        lengths = output.sequence_lengths.cpu().numpy()
+        sample_rate = model.config.sampling_rate
+        for waveform, length, output_filepath in zip(waveforms, lengths, output_filepaths):
+            pcm = (np.clip(waveform[:length], -1., 1.) * 32767).astype(np.int16)
+            encode_pcm(
+                    pcm, sample_rate, 1, output_filepath, codec_args=("-f", "mp3", "-q:a", "4"))
+
+
+def get_tts_types():
+    return ["gtts", "local"]
+
+
+def create_tts(type_: str):
+    tts_by = {
+            "gtts": GoogleTTS,
+            "local": LocalTTS,
+            }
+    return tts_by[type_]()
+
+
 def clip_by_script(
         audio_filepath,
         vtt_filepath,
@@ -145,39 +351,42 @@ def clip_by_script(
 
     matches = parse_vtt(vtt_filepath)
 
-    def process_section(idx, start, end, text, audio_offset=0, image_offset=0):
-        text = text.strip()
-        output_audio = os.path.join(output_dirpath, f"audio-{idx:04d}.mp3")
-
-        start_audio = convert_vtt_time(start, offset=offset_start)
-        end_audio   = convert_vtt_time(end, offset=offset_end)
+    ranges = [
+            (vtt_time_to_sec(start, offset_start), vtt_time_to_sec(end, offset_end))
+            for start, end, _ in matches]
+    output_audios = [
+            os.path.join(output_dirpath, f"audio-{idx:04d}.mp3")
+            for idx in range(len(matches))]
 
-        subprocess.run([
-            "ffmpeg", "-i", audio_filepath,
-            "-ss", start_audio, "-to", end_audio,
-            "-q:a", "0", "-map", "a", "-f", "mp3", output_audio, "-y"
-        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # 音声のデコードは一度だけ行い，各区間はそこから切り出す
+    done = cut_segments(audio_filepath, ranges, output_audios, cache=get_pcm_cache())
 
-        return {
+    results = [
+            {
                 "id": idx,
-                "filename": os.path.basename(output_audio),
-                "en_audio": output_audio,
-                "en": text
+                "filename": os.path.basename(output_audios[idx]),
+                "en_audio": output_audios[idx],
+                "en": matches[idx][2].strip()
                 }
-
-    results = []
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        futures = []
-        for idx, (start, end, text) in enumerate(matches):
-            futures.append(executor.submit(process_section, idx, start, end, text))
-        for future in tqdm(as_completed(futures), total=len(futures)):
-            try:
-                results.append(future.result())
-            except Exception as e:
-                ic(e)
+            for idx in done]
 
     subprocess.run(["reset"])
-    return sorted(results, key=lambda x: x["id"])
+    return results
+
+
+# 画像生成のプロファイル毎の既定のステップ数
+NUM_INFERENCE_STEPS_BY_PROFILE = {
+        "default": 50,
+        "fast-cpu": 20,
+        }
+
+
+def get_image_profiles():
+    return list(NUM_INFERENCE_STEPS_BY_PROFILE.keys())
+
+
+def get_default_num_inference_steps(profile):
+    return NUM_INFERENCE_STEPS_BY_PROFILE[profile]
 
 
 class ImageGenerator():
@@ -195,7 +404,10 @@ class ImageGenerator():
     def __init__(
             self,
             model_name,
-            safety=True):
+            safety=True,
+            profile="default",
+            compile=False,
+            num_threads=None):
         if safety:
             create_pipe = lambda model, dtype: StableDiffusionPipeline.from_pretrained(
                     model, torch_dtype=dtype)
@@ -203,25 +415,67 @@ class ImageGenerator():
             create_pipe = lambda model, dtype: StableDiffusionPipeline.from_pretrained(
                     model, torch_dtype=dtype, safety_checker=None)
 
-        try:
-            pipe = create_pipe(model_name, torch.float16)
-            ic("float 16")
-        except:
+        self.profile = profile
+        if profile == "fast-cpu":
+            # CPUではfloat16の演算が遅いので最初からfloat32にする
             pipe = create_pipe(model_name, torch.float32)
             ic("float 32")
-        ic(model_name)
-        device = "mps" if torch.backends.mps.is_available() else "cpu"
+            pipe = self._apply_fast_cpu(pipe, compile, num_threads)
+            device = "cpu"
+        else:
+            try:
+                pipe = create_pipe(model_name, torch.float16)
+                ic("float 16")
+            except:
+                pipe = create_pipe(model_name, torch.float32)
+                ic("float 32")
+            device = "mps" if torch.backends.mps.is_available() else "cpu"
+        ic(model_name, profile)
         ic(device)
         self.pipe = pipe.to(device)
 
+    @staticmethod
+    def _apply_fast_cpu(pipe, compile, num_threads):
+        """少ないステップで収束するスケジューラと，CPU向けのメモリ配置やスレッド数にする"""
+        torch.set_num_threads(os.cpu_count() if num_threads is None else num_threads)
+        ic(torch.get_num_threads())
+        pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+        pipe.enable_attention_slicing()
+        pipe.unet.to(memory_format=torch.channels_last)
+        pipe.vae.to(memory_format=torch.channels_last)
+        if compile:
+            pipe.unet = torch.compile(pipe.unet)
+        return pipe
+
     def generate(
             self,
             prompt,
             height,
             width,
-            negative_prompt="ext, letters, words, watermark, negative"):
+            negative_prompt="ext, letters, words, watermark, negative",
+            num_inference_steps=None,
+            seed=None):
+        """
+        promptにリストを渡すとまとめて一度に生成し，同じ順番で画像を返す
+        seedを指定すると各プロンプトに同じseedの乱数を使うので，
+        まとめ方によらず同じプロンプトからは同じ画像ができる
+        """
+        prompts = [prompt] if isinstance(prompt, str) else list(prompt)
+        if isinstance(negative_prompt, str) or negative_prompt is None:
+            negative_prompts = [negative_prompt] * len(prompts)
+        else:
+            negative_prompts = list(negative_prompt)
+        generator = None
+        if seed is not None:
+            generator = [
+                    torch.Generator("cpu").manual_seed(seed)
+                    for _ in prompts]
+        if num_inference_steps is None:
+            num_inference_steps = get_default_num_inference_steps(self.profile)
         return self.pipe(
-                prompt=prompt,
-                negative_prompt=negative_prompt,
+                prompt=prompts,
+                negative_prompt=negative_prompts,
                 height=height,
-                width=width).images
+                width=width,
+                num_inference_steps=num_inference_steps,
+                generator=generator).images
@@ -0,0 +1,69 @@
+import os
+import re
+import bisect
+import shutil
+import tempfile
+import subprocess
+
+
+def parse_showinfo_frame_times(stderr):
+    """
+    showinfoのログから各フレームの時刻[sec]を求める
+    pts_timeは古いffmpegだと%.6gで丸められるので，整数のptsとtime_baseから計算する
+    """
+    m = re.search(r"Parsed_showinfo.*?config in time_base:\s*(\d+)/(\d+)", stderr)
+    if m is None:
+        return [
+            float(t) for t in re.findall(
+                r"Parsed_showinfo.*?pts_time:\s*([-\d.]+)", stderr)]
+    # ffmpegと同じく pts * av_q2d(time_base) で計算する
+    time_base = int(m.group(1)) / int(m.group(2))
+    return [
+        int(pts) * time_base for pts in re.findall(
+            r"Parsed_showinfo.*?\bn:\s*\d+\s+pts:\s*(-?\d+)", stderr)]
+
+
+def match_frames(frame_times, times):
+    """各時刻以降で最初に選ばれたフレームの番号を返す．なければNone"""
+    indices = list()
+    for t in times:
+        j = bisect.bisect_left(frame_times, round(t, 3))
+        indices.append(j if j < len(frame_times) else None)
+    return indices
+
+
+def extract_frames(video_filepath, times, output_filepaths):
+    """
+    各時刻[sec]以降の最初のフレームを，動画を一度だけデコードして画像として書き出す
+    selectフィルタで必要なフレームだけを選び，showinfoの出力から各フレームの時刻を得る
+    成功した出力ファイルのインデックスのリストを返す
+    """
+    if len(times) == 0:
+        return []
+    targets = sorted(set([round(t, 3) for t in times]))
+    expr = "+".join([
+        f"gte(t,{t})*(isnan(prev_pts)+lt(prev_pts*TB,{t}))" for t in targets])
+
+    with tempfile.TemporaryDirectory() as tmp_dirpath:
+        filter_filepath = os.path.join(tmp_dirpath, "filter.txt")
+        with open(filter_filepath, "w") as f:
+            f.write(f"select='{expr}',showinfo")
+        proc = subprocess.run([
+            "ffmpeg", "-i", video_filepath,
+            "-filter_script:v", filter_filepath,
+            "-an", "-vsync", "vfr", "-q:v", "2",
+            os.path.join(tmp_dirpath, "frame-%06d.jpg"), "-y"
+        ], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE, text=True)
+        frame_times = parse_showinfo_frame_times(proc.stderr)
+
+        done = list()
+        for idx, j in enumerate(match_frames(frame_times, times)):
+            if j is None:
+                continue
+            frame_filepath = os.path.join(tmp_dirpath, f"frame-{j + 1:06d}.jpg")
+            if not os.path.exists(frame_filepath):
+                continue
+            shutil.copyfile(frame_filepath, output_filepaths[idx])
+            done.append(idx)
+    return done
@@ -0,0 +1,41 @@
+from types import SimpleNamespace
+
+from ankihelper.packing import (
+        pack_texts,
+        split_translated_lines,
+        )
+
+
+def _translated(parts, should_spacing):
+    """googletrans 4.0.0rc1 と同じく .text は部分を空白か空文字で繋いだもの"""
+    parts = [SimpleNamespace(text=p, candidates=[]) for p in parts]
+    return SimpleNamespace(
+            text=(" " if should_spacing else "").join([p.text for p in parts]),
+            extra_data={"parts": parts})
+
+
+def test_pack_texts_respects_max_chars():
+    packs = pack_texts(["a" * 4, "b" * 4, "c" * 4], 10)
+    assert packs == [["a" * 4, "b" * 4], ["c" * 4]]
+
+
+def test_split_keeps_newlines_inside_parts():
+    # 空白で繋ぐと改行の後ろに空白が入るが，部分を直接繋げば改行で分けられる
+    translated = _translated(["Hello.\n", "How are you?\n", "Bye."], True)
+    assert split_translated_lines(translated, 3) == ["Hello.", "How are you?", "Bye."]
+
+
+def test_split_japanese_parts_joined_without_spaces():
+    translated = _translated(["こんにちは。\n", "元気ですか？\n", "さようなら。"], False)
+    assert split_translated_lines(translated, 3) == ["こんにちは。", "元気ですか？", "さようなら。"]
+
+
+def test_split_returns_none_when_newlines_are_lost():
+    # 改行が消えて部分の数だけが合っていても，ずれを検出できないので使わない
+    translated = _translated(["こんにちは。", "元気ですか？", "さようなら。"], False)
+    assert split_translated_lines(translated, 3) is None
+
+
+def test_split_falls_back_to_text_without_parts():
+    translated = SimpleNamespace(text="a\nb", extra_data=None)
+    assert split_translated_lines(translated, 2) == ["a", "b"]
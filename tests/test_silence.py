@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+pydub = pytest.importorskip("pydub")
+from pydub.silence import detect_nonsilent
+
+from ankihelper.silence import NonsilentDetector
+
+
+def _detect(x, sample_rate, min_silence_len, silence_thresh, seek_step, block_size):
+    detector = NonsilentDetector(
+            sample_rate,
+            min_silence_len=min_silence_len,
+            silence_thresh=silence_thresh,
+            seek_step=seek_step)
+    ranges = list()
+    for i in range(0, len(x), block_size):
+        ranges += detector.feed(x[i:i + block_size])
+    ranges += detector.finish()
+    return ranges
+
+
+def _expected(x, sample_rate, min_silence_len, silence_thresh, seek_step):
+    seg = pydub.AudioSegment(
+            x.tobytes(), frame_rate=sample_rate, sample_width=2, channels=x.shape[1])
+    return [
+        tuple(r)
+        for r in detect_nonsilent(seg, min_silence_len, silence_thresh, seek_step)]
+
+
+def test_seek_step_matches_pydub():
+    sample_rate = 8000
+    x = np.zeros((sample_rate * 2, 1), dtype=np.int16)
+    x[int(0.9 * sample_rate):int(0.95 * sample_rate)] = 10000
+    expected = _expected(x, sample_rate, 125, -40, 10)
+    assert expected == [(895, 950)]
+    assert _detect(x, sample_rate, 125, -40, 10, 1000) == expected
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_random_audio_matches_pydub(seed):
+    rng = np.random.default_rng(seed)
+    sample_rate = int(rng.choice([8000, 16000, 22050, 44100]))
+    channels = int(rng.choice([1, 2]))
+    n = int(rng.integers(sample_rate // 2, sample_rate * 3))
+    x = rng.integers(-30, 30, size=(n, channels)).astype(np.int16)
+    for _ in range(rng.integers(0, 6)):
+        st = rng.integers(0, n)
+        et = min(n, st + rng.integers(1, sample_rate // 2))
+        x[st:et] = rng.integers(-20000, 20000, size=(et - st, channels))
+    min_silence_len = int(rng.choice([50, 125, 300, 700]))
+    seek_step = int(rng.choice([1, 3, 10, min_silence_len]))
+    silence_thresh = float(rng.choice([-50, -40, -16]))
+    block_size = int(rng.integers(100, sample_rate))
+
+    assert _detect(
+            x, sample_rate, min_silence_len, silence_thresh, seek_step, block_size
+            ) == _expected(x, sample_rate, min_silence_len, silence_thresh, seek_step)
+
+
+def test_rejects_seek_step_longer_than_window():
+    with pytest.raises(ValueError):
+        NonsilentDetector(8000, min_silence_len=100, seek_step=200)
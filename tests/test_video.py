@@ -0,0 +1,38 @@
+from ankihelper.video import (
+        parse_showinfo_frame_times,
+        match_frames,
+        )
+
+
+def _showinfo_log(time_base, frames):
+    """ffmpeg 6 までと同じく pts_time を %.6g で出したshowinfoのログ"""
+    num, den = time_base
+    lines = [
+        "Input #0, mov,mp4,m4a,3gp,3g2,mj2, from 'video.mp4':",
+        f"[Parsed_showinfo_1 @ 0x5581] config in time_base: {num}/{den}, frame_rate: 25/1",
+        ]
+    for n, pts in enumerate(frames):
+        lines.append(
+            f"[Parsed_showinfo_1 @ 0x5581] n:{n:4d} pts:{pts:7d} "
+            f"pts_time:{pts * num / den:<7.6g} duration:    512 "
+            f"fmt:yuv420p cl:left sar:1/1 s:640x360 i:P iskey:0 type:P")
+    lines.append("frame=    2 fps=0.0 q=2.0 Lsize=N/A time=00:21:40.00")
+    return "\n".join(lines)
+
+
+def test_frames_after_1000_sec_keep_their_cue():
+    # 1234.5648秒のフレームは %.6g だと 1234.56 と出てcueの開始(1234.564)より前に見える
+    stderr = _showinfo_log((1, 10000), [12345648, 13000000])
+    frame_times = parse_showinfo_frame_times(stderr)
+    assert frame_times == [1234.5648, 1300.0]
+    assert match_frames(frame_times, [1234.5641, 1299.99, 1300.0]) == [0, 1, 1]
+
+
+def test_cue_after_last_frame_has_no_frame():
+    frame_times = parse_showinfo_frame_times(_showinfo_log((1, 12800), [12800 * 1001]))
+    assert match_frames(frame_times, [1001.0, 1002.0]) == [0, None]
+
+
+def test_falls_back_to_pts_time_without_time_base():
+    stderr = "[Parsed_showinfo_0 @ 0x1] n:   0 pts:    100 pts_time:4   duration:25"
+    assert parse_showinfo_frame_times(stderr) == [4.0]